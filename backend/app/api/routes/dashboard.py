@@ -9,18 +9,24 @@ Provides endpoints for:
 """
 
 from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import ORJSONResponse, Response
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy import func, and_, case
+from sqlalchemy import func, and_, case, tuple_, text, cast, String
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple
 from uuid import UUID
+import base64
+import binascii
 import logging
+import orjson
 
 from app.core.database import get_db
 from app.models import Order, OrderStatus, Payment, PaymentStatus, PrintJob, PrintStatus, Shop
+from app.services import stats_service
+from app.services.stats_service import mv_daily_order_stats
 
-router = APIRouter()
+router = APIRouter(default_response_class=ORJSONResponse)
 logger = logging.getLogger(__name__)
 
 
@@ -33,106 +39,121 @@ async def get_dashboard_stats(
     """
     Get dashboard statistics.
     
+    Orders last updated before the rollup's `as_of` cutoff are read from
+    the `mv_daily_order_stats` view; orders updated since are aggregated
+    live, so the current day stays fresh. An order in the view that is
+    updated again counts in both parts until the next refresh.
+    The period covers `days` whole days plus today. Responses are cached
+    in Redis for a few seconds per (shop_id, days).
+    
     Returns:
     - Total orders (by status)
     - Revenue (today, week, month, total)
     - Print job stats (pending, completed, failed)
     """
+    cache_key = await stats_service.stats_cache_key(shop_id, days)
+    cached = await stats_service.get_cached_stats(cache_key)
+    if cached:
+        return Response(content=cached, media_type="application/json")
+    
     try:
-        start_date = datetime.utcnow() - timedelta(days=days)
+        # Reporting only - run the whole request in a read-only transaction
+        await db.execute(text("SET TRANSACTION READ ONLY"))
+        
         today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        start_date = today_start - timedelta(days=days)
         week_start = today_start - timedelta(days=7)
         month_start = today_start - timedelta(days=30)
         
-        # Base conditions
-        conditions = [Order.created_at >= start_date]
+        # Historical buckets (orders last updated before the cutoff) from the rollup view
+        mv = mv_daily_order_stats
+        mv_conditions = [mv.c.created_day >= start_date]
         if shop_id:
-            conditions.append(Order.shop_id == shop_id)
+            mv_conditions.append(mv.c.shop_id == shop_id)
         
-        # Order counts by status
-        order_stats = await db.execute(
+        mv_paid = mv.c.order_status == OrderStatus.PAID.value
+        history = (await db.execute(
             select(
-                Order.order_status,
-                func.count(Order.id).label("count")
+                func.sum(mv.c.order_count).filter(mv.c.order_status == OrderStatus.DRAFT.value).label("draft"),
+                func.sum(mv.c.order_count).filter(mv.c.order_status == OrderStatus.PAYMENT_PENDING.value).label("payment_pending"),
+                func.sum(mv.c.order_count).filter(mv_paid).label("paid"),
+                func.sum(mv.c.order_count).filter(mv.c.order_status == OrderStatus.CANCELLED.value).label("cancelled"),
+                func.sum(mv.c.order_count).label("total"),
+                func.sum(mv.c.revenue_sum).filter(mv_paid).label("period_revenue"),
+                func.sum(mv.c.revenue_sum).filter(and_(mv_paid, mv.c.updated_day >= week_start)).label("week_revenue"),
+                func.sum(mv.c.revenue_sum).filter(and_(mv_paid, mv.c.updated_day >= month_start)).label("month_revenue"),
+                # Same on every row; an empty view has covered nothing yet
+                select(mv.c.as_of).limit(1).scalar_subquery().label("as_of"),
             )
-            .where(and_(*conditions))
-            .group_by(Order.order_status)
-        )
-        order_counts = {row.order_status.value: row.count for row in order_stats.fetchall()}
+            .where(and_(*mv_conditions))
+        )).one()
         
-        # Revenue calculation (only PAID orders)
-        paid_conditions = conditions + [Order.order_status == OrderStatus.PAID]
-        
-        # Total revenue
-        total_revenue_result = await db.execute(
-            select(func.sum(Order.amount))
-            .where(and_(*paid_conditions))
-        )
-        total_revenue = float(total_revenue_result.scalar() or 0)
-        
-        # Today's revenue
-        today_conditions = paid_conditions + [Order.updated_at >= today_start]
-        today_revenue_result = await db.execute(
-            select(func.sum(Order.amount))
-            .where(and_(*today_conditions))
-        )
-        today_revenue = float(today_revenue_result.scalar() or 0)
+        # Live delta: orders touched since the cutoff (normally today, plus the
+        # end of yesterday until the post-midnight refresh), in a single pass
+        live_start = history.as_of or start_date
+        conditions = [Order.created_at >= start_date, Order.updated_at >= live_start]
+        if shop_id:
+            conditions.append(Order.shop_id == shop_id)
         
-        # Week's revenue
-        week_conditions = paid_conditions + [Order.updated_at >= week_start]
-        week_revenue_result = await db.execute(
-            select(func.sum(Order.amount))
-            .where(and_(*week_conditions))
-        )
-        week_revenue = float(week_revenue_result.scalar() or 0)
+        is_paid = Order.order_status == OrderStatus.PAID
+        live = (await db.execute(
+            select(
+                func.count().filter(Order.order_status == OrderStatus.DRAFT).label("draft"),
+                func.count().filter(Order.order_status == OrderStatus.PAYMENT_PENDING).label("payment_pending"),
+                func.count().filter(is_paid).label("paid"),
+                func.count().filter(Order.order_status == OrderStatus.CANCELLED).label("cancelled"),
+                func.count().label("total"),
+                func.sum(Order.amount).filter(is_paid).label("revenue"),
+                func.sum(Order.amount).filter(and_(is_paid, Order.updated_at >= today_start)).label("today_revenue"),
+            )
+            .where(and_(*conditions))
+        )).one()
         
-        # Month's revenue
-        month_conditions = paid_conditions + [Order.updated_at >= month_start]
-        month_revenue_result = await db.execute(
-            select(func.sum(Order.amount))
-            .where(and_(*month_conditions))
-        )
-        month_revenue = float(month_revenue_result.scalar() or 0)
+        live_revenue = float(live.revenue or 0)
+        today_revenue = float(live.today_revenue or 0)
         
         # Print job stats
         print_conditions = [PrintJob.created_at >= start_date]
         if shop_id:
             print_conditions.append(PrintJob.shop_id == shop_id)
         
-        print_stats = await db.execute(
+        print_row = (await db.execute(
             select(
-                PrintJob.print_status,
-                func.count(PrintJob.id).label("count")
+                func.count().filter(PrintJob.print_status == PrintStatus.QUEUED).label("queued"),
+                func.count().filter(PrintJob.print_status == PrintStatus.PRINTING).label("printing"),
+                func.count().filter(PrintJob.print_status == PrintStatus.COMPLETED).label("completed"),
+                func.count().filter(PrintJob.print_status == PrintStatus.FAILED).label("failed"),
             )
             .where(and_(*print_conditions))
-            .group_by(PrintJob.print_status)
-        )
-        print_counts = {row.print_status.value: row.count for row in print_stats.fetchall()}
+        )).one()
         
-        return {
+        payload = orjson.dumps({
             "period_days": days,
             "orders": {
-                "draft": order_counts.get("DRAFT", 0),
-                "payment_pending": order_counts.get("PAYMENT_PENDING", 0),
-                "paid": order_counts.get("PAID", 0),
-                "cancelled": order_counts.get("CANCELLED", 0),
-                "total": sum(order_counts.values())
+                "draft": int(history.draft or 0) + live.draft,
+                "payment_pending": int(history.payment_pending or 0) + live.payment_pending,
+                "paid": int(history.paid or 0) + live.paid,
+                "cancelled": int(history.cancelled or 0) + live.cancelled,
+                "total": int(history.total or 0) + live.total
             },
             "revenue": {
                 "today": today_revenue,
-                "week": week_revenue,
-                "month": month_revenue,
-                "period_total": total_revenue,
+                "week": float(history.week_revenue or 0) + live_revenue,
+                "month": float(history.month_revenue or 0) + live_revenue,
+                "period_total": float(history.period_revenue or 0) + live_revenue,
                 "currency": "INR"
             },
             "print_jobs": {
-                "queued": print_counts.get("QUEUED", 0),
-                "printing": print_counts.get("PRINTING", 0),
-                "completed": print_counts.get("COMPLETED", 0),
-                "failed": print_counts.get("FAILED", 0)
+                "queued": print_row.queued,
+                "printing": print_row.printing,
+                "completed": print_row.completed,
+                "failed": print_row.failed
             },
-            "generated_at": datetime.utcnow().isoformat()
-        }
+            "generated_at": datetime.utcnow()
+        })
+        await stats_service.cache_stats(cache_key, payload)
+        
+        return Response(content=payload, media_type="application/json")
         
     except Exception as e:
         logger.error(f"Error fetching dashboard stats: {e}", exc_info=True)
@@ -144,17 +165,18 @@ async def list_orders(
     shop_id: Optional[UUID] = None,
     status_filter: Optional[str] = Query(None, alias="status"),
     limit: int = Query(50, ge=1, le=100),
-    offset: int = Query(0, ge=0),
+    cursor: Optional[str] = Query(None),
     db: AsyncSession = Depends(get_db)
 ):
     """
     List orders with optional filters.
     
     For dashboard order management view.
+    
+    Uses keyset pagination on (created_at, id): pass the `next_cursor`
+    from the previous page as `cursor` to fetch the next one.
     """
     try:
-        query = select(Order)
-        
         # Apply filters
         conditions = []
         if shop_id:
@@ -164,48 +186,98 @@ async def list_orders(
             if status_upper in OrderStatus.__members__:
                 conditions.append(Order.order_status == OrderStatus[status_upper])
         
+        if cursor:
+            # The window count would only see rows past the cursor,
+            # so count the full match set in a scalar subquery instead
+            count_query = select(func.count()).select_from(Order)
+            if conditions:
+                count_query = count_query.where(and_(*conditions))
+            total_column = count_query.correlate(None).scalar_subquery().label("total_count")
+            
+            cursor_created_at, cursor_id = _decode_cursor(cursor)
+            conditions.append(
+                tuple_(Order.created_at, Order.id) < tuple_(cursor_created_at, cursor_id)
+            )
+        else:
+            # First page: the window count gives the total in the same scan
+            total_column = func.count().over().label("total_count")
+        
+        # Select only the listed columns - plain rows, no ORM hydration.
+        # Enum columns come back as their stored strings, ready to serialize.
+        query = select(
+            Order.id,
+            Order.customer_phone,
+            Order.file_name,
+            cast(Order.print_type, String).label("print_type"),
+            Order.copies,
+            Order.amount,
+            cast(Order.order_status, String).label("order_status"),
+            Order.created_at,
+            Order.updated_at,
+            total_column
+        )
+        
         if conditions:
             query = query.where(and_(*conditions))
         
-        # Order by creation time (newest first)
-        query = query.order_by(Order.created_at.desc())
-        query = query.offset(offset).limit(limit)
+        # Order by creation time (newest first), id breaks ties
+        query = query.order_by(Order.created_at.desc(), Order.id.desc())
+        query = query.limit(limit)
         
         result = await db.execute(query)
-        orders = result.scalars().all()
+        orders = result.all()
         
-        # Get total count
-        count_query = select(func.count(Order.id))
-        if conditions:
-            count_query = count_query.where(and_(*conditions))
-        count_result = await db.execute(count_query)
-        total_count = count_result.scalar()
+        # Every row carries the same total; an empty page reports 0
+        total_count = orders[0].total_count if orders else 0
+        
+        next_cursor = None
+        if len(orders) == limit:
+            last = orders[-1]
+            next_cursor = _encode_cursor(last.created_at, last.id)
         
-        return {
+        return ORJSONResponse({
             "orders": [
                 {
-                    "id": str(order.id),
+                    "id": order.id,
                     "customer_phone": order.customer_phone,
                     "file_name": order.file_name,
-                    "print_type": order.print_type.value if order.print_type else None,
+                    "print_type": order.print_type,
                     "copies": order.copies,
                     "amount": float(order.amount) if order.amount else 0,
-                    "order_status": order.order_status.value,
-                    "created_at": order.created_at.isoformat() if order.created_at else None,
-                    "updated_at": order.updated_at.isoformat() if order.updated_at else None
+                    "order_status": order.order_status,
+                    "created_at": order.created_at,
+                    "updated_at": order.updated_at
                 }
                 for order in orders
             ],
             "total": total_count,
-            "offset": offset,
+            "next_cursor": next_cursor,
             "limit": limit
-        }
+        })
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error listing orders: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
 
+def _encode_cursor(created_at: datetime, order_id: UUID) -> str:
+    """Encode a keyset pagination cursor as URL-safe base64."""
+    raw = f"{created_at.isoformat()}|{order_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def _decode_cursor(cursor: str) -> Tuple[datetime, UUID]:
+    """Decode a cursor produced by _encode_cursor."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        created_at, order_id = raw.split("|", 1)
+        return datetime.fromisoformat(created_at), UUID(order_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
 @router.get("/orders/{order_id}")
 async def get_order_details(
     order_id: UUID,
@@ -232,8 +304,8 @@ async def get_order_details(
         if not order:
             raise HTTPException(status_code=404, detail="Order not found")
         
-        return {
-            "id": str(order.id),
+        return ORJSONResponse({
+            "id": order.id,
             "customer_phone": order.customer_phone,
             "file_name": order.file_name,
             "file_url": order.file_url,
@@ -243,23 +315,23 @@ async def get_order_details(
             "amount": float(order.amount) if order.amount else 0,
             "order_status": order.order_status.value,
             "razorpay_payment_link_id": order.razorpay_payment_link_id,
-            "created_at": order.created_at.isoformat() if order.created_at else None,
-            "updated_at": order.updated_at.isoformat() if order.updated_at else None,
+            "created_at": order.created_at,
+            "updated_at": order.updated_at,
             "payment": {
-                "id": str(order.payment.id),
+                "id": order.payment.id,
                 "status": order.payment.payment_status.value,
                 "provider_reference": order.payment.provider_reference,
                 "amount": float(order.payment.amount),
-                "paid_at": order.payment.paid_at.isoformat() if order.payment.paid_at else None
+                "paid_at": order.payment.paid_at
             } if order.payment else None,
             "print_job": {
-                "id": str(order.print_job.id),
+                "id": order.print_job.id,
                 "status": order.print_job.print_status.value,
                 "retry_count": order.print_job.retry_count,
-                "printed_at": order.print_job.printed_at.isoformat() if order.print_job.printed_at else None,
+                "printed_at": order.print_job.printed_at,
                 "last_error": order.print_job.last_error
             } if order.print_job else None
-        }
+        })
         
     except HTTPException:
         raise
@@ -279,35 +351,42 @@ async def get_pending_jobs(
     Useful for monitoring the print queue.
     """
     try:
-        from sqlalchemy.orm import selectinload
-        
         conditions = [PrintJob.print_status.in_([PrintStatus.QUEUED, PrintStatus.PRINTING])]
         if shop_id:
             conditions.append(PrintJob.shop_id == shop_id)
         
+        # Join and project only the order columns we return
         result = await db.execute(
-            select(PrintJob)
-            .options(selectinload(PrintJob.order))
+            select(
+                PrintJob.id,
+                PrintJob.order_id,
+                cast(PrintJob.print_status, String).label("print_status"),
+                PrintJob.created_at,
+                Order.file_name,
+                Order.copies,
+                Order.customer_phone
+            )
+            .join(Order, Order.id == PrintJob.order_id)
             .where(and_(*conditions))
             .order_by(PrintJob.created_at.asc())  # FIFO order
         )
-        jobs = result.scalars().all()
+        jobs = result.all()
         
-        return {
+        return ORJSONResponse({
             "pending_jobs": [
                 {
-                    "id": str(job.id),
-                    "order_id": str(job.order_id),
-                    "file_name": job.order.file_name if job.order else None,
-                    "copies": job.order.copies if job.order else 1,
-                    "print_status": job.print_status.value,
-                    "created_at": job.created_at.isoformat() if job.created_at else None,
-                    "customer_phone": job.order.customer_phone if job.order else None
+                    "id": job.id,
+                    "order_id": job.order_id,
+                    "file_name": job.file_name,
+                    "copies": job.copies or 1,
+                    "print_status": job.print_status,
+                    "created_at": job.created_at,
+                    "customer_phone": job.customer_phone
                 }
                 for job in jobs
             ],
             "total": len(jobs)
-        }
+        })
         
     except Exception as e:
         logger.error(f"Error fetching pending jobs: {e}", exc_info=True)
@@ -323,36 +402,44 @@ async def get_failed_jobs(
     Get all failed print jobs for manual intervention.
     """
     try:
-        from sqlalchemy.orm import selectinload
-        
         conditions = [PrintJob.print_status == PrintStatus.FAILED]
         if shop_id:
             conditions.append(PrintJob.shop_id == shop_id)
         
+        # Join and project only the order columns we return
         result = await db.execute(
-            select(PrintJob)
-            .options(selectinload(PrintJob.order))
+            select(
+                PrintJob.id,
+                PrintJob.order_id,
+                PrintJob.retry_count,
+                PrintJob.max_retries,
+                PrintJob.last_error,
+                PrintJob.updated_at,
+                Order.file_name,
+                Order.customer_phone
+            )
+            .join(Order, Order.id == PrintJob.order_id)
             .where(and_(*conditions))
             .order_by(PrintJob.updated_at.desc())
         )
-        jobs = result.scalars().all()
+        jobs = result.all()
         
-        return {
+        return ORJSONResponse({
             "failed_jobs": [
                 {
-                    "id": str(job.id),
-                    "order_id": str(job.order_id),
-                    "file_name": job.order.file_name if job.order else None,
+                    "id": job.id,
+                    "order_id": job.order_id,
+                    "file_name": job.file_name,
                     "retry_count": job.retry_count,
                     "max_retries": job.max_retries,
                     "last_error": job.last_error,
-                    "updated_at": job.updated_at.isoformat() if job.updated_at else None,
-                    "customer_phone": job.order.customer_phone if job.order else None
+                    "updated_at": job.updated_at,
+                    "customer_phone": job.customer_phone
                 }
                 for job in jobs
             ],
             "total": len(jobs)
-        }
+        })
         
     except Exception as e:
         logger.error(f"Error fetching failed jobs: {e}", exc_info=True)
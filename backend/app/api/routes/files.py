@@ -7,17 +7,23 @@ Serves uploaded files for:
 """
 
 from fastapi import APIRouter, HTTPException, Header, Path
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, ORJSONResponse, Response
 from pathlib import Path as FilePath
+from typing import Optional
+from urllib.parse import quote
 import os
+import stat
 import logging
 
 from app.core.config import get_settings
 
-router = APIRouter()
+router = APIRouter(default_response_class=ORJSONResponse)
 logger = logging.getLogger(__name__)
 settings = get_settings()
 
+# Uploads root, resolved once (the storage path is fixed for the process)
+UPLOADS_DIR = os.path.normpath(os.path.abspath(settings.FILE_STORAGE_PATH))
+
 
 def verify_worker_api_key(x_api_key: str = Header(None, alias="X-API-Key")):
     """
@@ -34,15 +40,19 @@ def verify_worker_api_key(x_api_key: str = Header(None, alias="X-API-Key")):
 
 @router.get("/{file_path:path}")
 async def serve_file(
-    file_path: str = Path(..., description="Path to the file relative to uploads directory")
+    file_path: str = Path(..., description="Path to the file relative to uploads directory"),
+    if_none_match: Optional[str] = Header(None)
 ):
     """
     Serve an uploaded file.
     
-    Files are stored with hashed names for security.
+    Files are stored with content-hashed names, so they never change once
+    written and can be cached aggressively. Clients revalidating with
+    If-None-Match get a 304 without the file being opened.
     
     Args:
         file_path: Relative path within uploads directory
+        if_none_match: ETag from a previous download
     """
     try:
         # Sanitize path to prevent directory traversal
@@ -56,23 +66,38 @@ async def serve_file(
             logger.warning(f"Path traversal attempt: {file_path}")
             raise HTTPException(status_code=400, detail="Invalid file path")
         
-        # Build full path
-        full_path = os.path.join(settings.FILE_STORAGE_PATH, safe_path)
-        full_path = os.path.normpath(full_path)
+        # Build full path (already absolute, since UPLOADS_DIR is)
+        full_path = os.path.normpath(os.path.join(UPLOADS_DIR, safe_path))
         
-        # Verify the path is within uploads directory
-        uploads_dir = os.path.normpath(os.path.abspath(settings.FILE_STORAGE_PATH))
-        file_abs_path = os.path.normpath(os.path.abspath(full_path))
+        # Verify the path is within uploads directory. commonpath compares
+        # whole components, so "/uploads2" does not pass as "/uploads".
+        try:
+            within_uploads = os.path.commonpath([UPLOADS_DIR, full_path]) == UPLOADS_DIR
+        except ValueError:  # Different drives on Windows
+            within_uploads = False
         
-        if not file_abs_path.startswith(uploads_dir):
+        if not within_uploads:
             logger.warning(f"Path escape attempt: {file_path} -> {full_path}")
             raise HTTPException(status_code=400, detail="Invalid file path")
         
-        # Check if file exists
-        if not os.path.isfile(full_path):
+        # Check if file exists (single stat, reused for the response)
+        try:
+            st = os.stat(full_path)
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
             logger.warning(f"File not found: {full_path}")
             raise HTTPException(status_code=404, detail="File not found")
         
+        etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+        cache_headers = {
+            "Cache-Control": "public, max-age=3600, immutable",
+            "ETag": etag,
+        }
+        
+        if if_none_match and etag in if_none_match:
+            return Response(status_code=304, headers=cache_headers)
+        
         # Determine content type
         content_type = get_content_type(full_path)
         
@@ -81,10 +106,23 @@ async def serve_file(
         
         logger.info(f"Serving file: {safe_path}")
         
+        if settings.FILE_ACCEL_REDIRECT_PREFIX:
+            # Auth and headers only - nginx streams the bytes with sendfile()
+            return Response(
+                media_type=content_type,
+                headers={
+                    **cache_headers,
+                    "X-Accel-Redirect": settings.FILE_ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + quote(safe_path),
+                    "Content-Disposition": _content_disposition(filename),
+                }
+            )
+        
         return FileResponse(
             path=full_path,
             media_type=content_type,
-            filename=filename
+            filename=filename,
+            stat_result=st,
+            headers=cache_headers
         )
         
     except HTTPException:
@@ -94,25 +132,34 @@ async def serve_file(
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
 
+def _content_disposition(filename: str) -> str:
+    """Attachment header, matching what FileResponse sends."""
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+# Extension -> MIME type for served files
+_CONTENT_TYPES = {
+    ".pdf": "application/pdf",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".gif": "image/gif",
+    ".doc": "application/msword",
+    ".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    ".xls": "application/vnd.ms-excel",
+    ".xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ".ppt": "application/vnd.ms-powerpoint",
+    ".pptx": "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+    ".txt": "text/plain",
+}
+
+
 def get_content_type(file_path: str) -> str:
     """
     Determine content type from file extension.
     """
-    ext = os.path.splitext(file_path)[1].lower()
-    
-    content_types = {
-        ".pdf": "application/pdf",
-        ".jpg": "image/jpeg",
-        ".jpeg": "image/jpeg",
-        ".png": "image/png",
-        ".gif": "image/gif",
-        ".doc": "application/msword",
-        ".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-        ".xls": "application/vnd.ms-excel",
-        ".xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        ".ppt": "application/vnd.ms-powerpoint",
-        ".pptx": "application/vnd.openxmlformats-officedocument.presentationml.presentation",
-        ".txt": "text/plain",
-    }
-    
-    return content_types.get(ext, "application/octet-stream")
+    ext = file_path[file_path.rfind("."):].lower()
+    return _CONTENT_TYPES.get(ext, "application/octet-stream")
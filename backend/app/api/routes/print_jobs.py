@@ -6,33 +6,36 @@ Endpoints used by:
 2. Dashboard - to view job status
 """
 
-from fastapi import APIRouter, Depends, HTTPException, status, Header, Query
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status, Header, Query
+from fastapi.responses import ORJSONResponse, Response
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy.orm import selectinload
-from sqlalchemy import and_
-from datetime import datetime
+from sqlalchemy.orm import load_only, joinedload, raiseload
+from sqlalchemy import and_, cast, func, update, String
 from typing import Optional
 from uuid import UUID
-import os
+import hmac
 import logging
+import orjson
 
 from app.core.database import get_db
 from app.core.config import get_settings
-from app.models import PrintJob, PrintStatus, Order, OrderStatus
-from app.services import twilio_service
+from app.models import PrintJob, PrintStatus, Order
+from app.services import twilio_service, queue_service
 
-router = APIRouter()
+router = APIRouter(default_response_class=ORJSONResponse)
 logger = logging.getLogger(__name__)
 settings = get_settings()
 
+# Encoded once for constant-time comparison
+_WORKER_KEY_BYTES = settings.WORKER_API_KEY.encode()
 
-def verify_worker_api_key(x_api_key: str = Header(None, alias="X-API-Key")):
+
+async def verify_worker_api_key(x_api_key: str = Header(None, alias="X-API-Key")):
     """
     Verify worker API key for protected endpoints.
     """
-    if not x_api_key or x_api_key != settings.WORKER_API_KEY:
+    if not x_api_key or not hmac.compare_digest(x_api_key.encode(), _WORKER_KEY_BYTES):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid or missing API key"
@@ -56,10 +59,32 @@ async def get_print_job(
     - Print configuration (copies, print type)
     - Job metadata
     """
+    cached, cache_version = await queue_service.get_cached_job(job_id)
+    if cached:
+        return Response(content=cached, media_type="application/json")
+    
     try:
+        # Single JOIN, only the columns the worker needs
         result = await db.execute(
             select(PrintJob)
-            .options(selectinload(PrintJob.order))
+            .options(
+                load_only(
+                    PrintJob.id,
+                    PrintJob.order_id,
+                    PrintJob.print_status,
+                    PrintJob.retry_count,
+                    PrintJob.max_retries,
+                    PrintJob.created_at
+                ),
+                joinedload(PrintJob.order).load_only(
+                    Order.file_url,
+                    Order.file_name,
+                    Order.copies,
+                    Order.print_type,
+                    Order.customer_phone
+                ),
+                raiseload("*")
+            )
             .where(PrintJob.id == job_id)
         )
         job = result.scalars().first()
@@ -69,9 +94,9 @@ async def get_print_job(
         
         order = job.order
         
-        return {
-            "id": str(job.id),
-            "order_id": str(job.order_id),
+        payload = orjson.dumps({
+            "id": job.id,
+            "order_id": job.order_id,
             "file_url": order.file_url,
             "file_name": order.file_name,
             "copies": order.copies,
@@ -80,8 +105,11 @@ async def get_print_job(
             "print_status": job.print_status.value,
             "retry_count": job.retry_count,
             "max_retries": job.max_retries,
-            "created_at": job.created_at.isoformat() if job.created_at else None
-        }
+            "created_at": job.created_at
+        })
+        await queue_service.cache_job(job_id, cache_version, payload)
+        
+        return Response(content=payload, media_type="application/json")
         
     except HTTPException:
         raise
@@ -93,7 +121,8 @@ async def get_print_job(
 @router.put("/{job_id}/status")
 async def update_print_job_status(
     job_id: UUID,
-    status_update: str = Query(..., alias="status"),
+    background_tasks: BackgroundTasks,
+    status_update: PrintStatus = Query(..., alias="status"),
     error_message: Optional[str] = Query(None),
     db: AsyncSession = Depends(get_db),
     _: bool = Depends(verify_worker_api_key)
@@ -112,50 +141,65 @@ async def update_print_job_status(
         error_message: Optional error message for FAILED status
     """
     try:
+        # Status is validated by FastAPI (422 on unknown values)
+        new_status = status_update
+        
+        values = {"print_status": new_status}
+        if new_status == PrintStatus.COMPLETED:
+            # Database clock, in UTC like the other naive timestamps
+            values["printed_at"] = func.timezone("utc", func.now())
+        elif new_status == PrintStatus.FAILED:
+            values["last_error"] = error_message
+            values["retry_count"] = PrintJob.retry_count + 1  # Server-side increment
+        
+        # Single round trip: update and read back what we report
         result = await db.execute(
-            select(PrintJob)
-            .options(selectinload(PrintJob.order))
+            update(PrintJob)
             .where(PrintJob.id == job_id)
+            .values(**values)
+            .returning(
+                PrintJob.print_status,
+                PrintJob.retry_count,
+                PrintJob.max_retries,
+                PrintJob.order_id,
+                PrintJob.printed_at
+            )
         )
-        job = result.scalars().first()
+        job = result.first()
         
         if not job:
             raise HTTPException(status_code=404, detail="Print job not found")
         
-        # Validate status
-        status_upper = status_update.upper()
-        if status_upper not in PrintStatus.__members__:
-            raise HTTPException(status_code=400, detail=f"Invalid status: {status_update}")
-        
-        new_status = PrintStatus[status_upper]
-        old_status = job.print_status
+        await db.commit()
+        await queue_service.invalidate_job_cache(str(job_id))
         
-        # Update job
-        job.print_status = new_status
+        logger.info(f"Job {job_id} -> {new_status}")
         
+        # Notify the customer on completion, or once retries are exhausted
+        notify_success = None
         if new_status == PrintStatus.COMPLETED:
-            job.printed_at = datetime.utcnow()
-            # Send completion notification to customer
-            await send_print_notification(job.order, success=True)
-            
-        elif new_status == PrintStatus.FAILED:
-            job.last_error = error_message
-            job.retry_count += 1
-            
-            # Check if we should notify customer
-            if job.retry_count >= job.max_retries:
-                await send_print_notification(job.order, success=False)
+            notify_success = True
+        elif new_status == PrintStatus.FAILED and job.retry_count >= job.max_retries:
+            notify_success = False
         
-        await db.commit()
-        await db.refresh(job)
-        
-        logger.info(f"Job {job_id}: {old_status} -> {new_status}")
+        if notify_success is not None:
+            order_result = await db.execute(
+                select(Order.id, Order.customer_phone).where(Order.id == job.order_id)
+            )
+            order_row = order_result.first()
+            if order_row:
+                # Send after the response so the worker doesn't wait on Twilio
+                background_tasks.add_task(
+                    send_print_notification, order_row.id, order_row.customer_phone,
+                    success=notify_success
+                )
         
         return {
             "status": "success",
-            "job_id": str(job.id),
+            "job_id": job_id,
             "print_status": job.print_status.value,
-            "retry_count": job.retry_count
+            "retry_count": job.retry_count,
+            "printed_at": job.printed_at
         }
         
     except HTTPException:
@@ -169,7 +213,7 @@ async def update_print_job_status(
 @router.get("")
 async def list_print_jobs(
     shop_id: Optional[UUID] = None,
-    status_filter: Optional[str] = Query(None, alias="status"),
+    status_filter: Optional[PrintStatus] = Query(None, alias="status"),
     limit: int = Query(50, ge=1, le=100),
     offset: int = Query(0, ge=0),
     db: AsyncSession = Depends(get_db),
@@ -180,17 +224,36 @@ async def list_print_jobs(
     
     Used by dashboard and worker for monitoring.
     """
+    cache_key = await queue_service.job_list_cache_key(
+        shop_id, status_filter.value if status_filter else None, limit, offset
+    )
+    cached = await queue_service.get_cached_payload(cache_key)
+    if cached:
+        return Response(content=cached, media_type="application/json")
+    
     try:
-        query = select(PrintJob).options(selectinload(PrintJob.order))
+        # Plain rows, no ORM hydration. The window count carries the
+        # total match count on every row.
+        query = (
+            select(
+                PrintJob.id,
+                PrintJob.order_id,
+                Order.file_name,
+                cast(PrintJob.print_status, String).label("print_status"),
+                PrintJob.retry_count,
+                PrintJob.created_at,
+                PrintJob.printed_at,
+                func.count().over().label("total_count")
+            )
+            .join(Order, Order.id == PrintJob.order_id)
+        )
         
         # Apply filters
         conditions = []
         if shop_id:
             conditions.append(PrintJob.shop_id == shop_id)
         if status_filter:
-            status_upper = status_filter.upper()
-            if status_upper in PrintStatus.__members__:
-                conditions.append(PrintJob.print_status == PrintStatus[status_upper])
+            conditions.append(PrintJob.print_status == status_filter)
         
         if conditions:
             query = query.where(and_(*conditions))
@@ -200,25 +263,31 @@ async def list_print_jobs(
         query = query.offset(offset).limit(limit)
         
         result = await db.execute(query)
-        jobs = result.scalars().all()
+        rows = result.all()
         
-        return {
+        # An empty page (e.g. offset past the end) reports 0
+        total_count = rows[0].total_count if rows else 0
+        
+        payload = orjson.dumps({
             "jobs": [
                 {
-                    "id": str(job.id),
-                    "order_id": str(job.order_id),
-                    "file_name": job.order.file_name if job.order else None,
-                    "print_status": job.print_status.value,
+                    "id": job.id,
+                    "order_id": job.order_id,
+                    "file_name": job.file_name,
+                    "print_status": job.print_status,
                     "retry_count": job.retry_count,
-                    "created_at": job.created_at.isoformat() if job.created_at else None,
-                    "printed_at": job.printed_at.isoformat() if job.printed_at else None
+                    "created_at": job.created_at,
+                    "printed_at": job.printed_at
                 }
-                for job in jobs
+                for job in rows
             ],
-            "total": len(jobs),
+            "total": total_count,
             "offset": offset,
             "limit": limit
-        }
+        })
+        await queue_service.cache_payload(cache_key, payload, queue_service.JOB_LIST_CACHE_TTL_SECONDS)
+        
+        return Response(content=payload, media_type="application/json")
         
     except Exception as e:
         logger.error(f"Error listing jobs: {e}", exc_info=True)
@@ -239,29 +308,34 @@ async def retry_print_job(
     from app.services.queue_service import enqueue_print_job
     
     try:
+        # Reset only if still FAILED; don't reset retry_count to track total attempts
         result = await db.execute(
-            select(PrintJob).where(PrintJob.id == job_id)
+            update(PrintJob)
+            .where(PrintJob.id == job_id, PrintJob.print_status == PrintStatus.FAILED)
+            .values(print_status=PrintStatus.QUEUED, last_error=None)
+            .returning(PrintJob.id)
         )
-        job = result.scalars().first()
-        
-        if not job:
-            raise HTTPException(status_code=404, detail="Print job not found")
         
-        if job.print_status != PrintStatus.FAILED:
+        if result.first() is None:
+            # Nothing updated - find out whether the job is missing or not FAILED
+            status_result = await db.execute(
+                select(PrintJob.print_status).where(PrintJob.id == job_id)
+            )
+            current_status = status_result.scalars().first()
+            
+            if current_status is None:
+                raise HTTPException(status_code=404, detail="Print job not found")
+            
             raise HTTPException(
                 status_code=400,
-                detail=f"Can only retry FAILED jobs, current status: {job.print_status.value}"
+                detail=f"Can only retry FAILED jobs, current status: {current_status.value}"
             )
         
-        # Reset job
-        job.print_status = PrintStatus.QUEUED
-        job.last_error = None
-        # Don't reset retry_count to track total attempts
-        
         await db.commit()
+        await queue_service.invalidate_job_cache(str(job_id))
         
         # Re-enqueue
-        enqueue_print_job(str(job.id))
+        await enqueue_print_job(str(job_id))
         
         logger.info(f"Job {job_id} retried, re-queued")
         
@@ -274,25 +348,25 @@ async def retry_print_job(
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
 
-async def send_print_notification(order: Order, success: bool):
+async def send_print_notification(order_id: UUID, customer_phone: Optional[str], success: bool):
     """
     Send WhatsApp notification about print completion.
     """
-    if not order or not order.customer_phone:
+    if not customer_phone:
         return
     
     try:
         if success:
-            message = twilio_service.msg_print_complete(str(order.id))
+            message = twilio_service.msg_print_complete(str(order_id))
         else:
-            message = twilio_service.msg_print_failed(str(order.id))
+            message = twilio_service.msg_print_failed(str(order_id))
         
         await twilio_service.send_whatsapp_message(
-            to=order.customer_phone,
+            to=customer_phone,
             body=message
         )
         
-        logger.info(f"Print notification sent to {order.customer_phone}, success={success}")
+        logger.info(f"Print notification sent to {customer_phone}, success={success}")
         
     except Exception as e:
         logger.error(f"Failed to send print notification: {e}")
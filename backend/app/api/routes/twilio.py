@@ -13,7 +13,7 @@ from fastapi import APIRouter, Form, Response, Depends, Request
 from sqlalchemy.ext.asyncio import AsyncSession
 from twilio.twiml.messaging_response import MessagingResponse
 import logging
-from typing import Optional
+from typing import Optional, Tuple
 from decimal import Decimal
 
 from app.core.database import get_db
@@ -23,6 +23,36 @@ from app.services import session_service, order_service, twilio_service
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
+MSG_ORDER_CANCELLED = "Order cancelled. Send a document to start a new order."
+MSG_AWAITING_PAYMENT = (
+    "⏳ Waiting for payment...\n\n"
+    "Please complete payment using the link sent earlier.\n\n"
+    "_Reply 'cancel' to cancel this order._"
+)
+MSG_ERROR = "Sorry, something went wrong. Please try again."
+
+
+def _render_twiml(message: Optional[str]) -> bytes:
+    """Render a TwiML reply containing a single (optional) message."""
+    resp = MessagingResponse()
+    if message:
+        resp.message(message)
+    return str(resp).encode()
+
+
+# Replies that never vary are rendered once at import
+_STATIC_TWIML = {
+    message: _render_twiml(message)
+    for message in (
+        twilio_service.msg_welcome(),
+        twilio_service.msg_invalid_copies(),
+        MSG_ORDER_CANCELLED,
+        MSG_AWAITING_PAYMENT,
+        MSG_ERROR,
+    )
+}
+_EMPTY_TWIML = _render_twiml(None)
+
 
 @router.post("")
 async def handle_twilio_webhook(
@@ -35,22 +65,37 @@ async def handle_twilio_webhook(
     NumMedia: str = Form(default="0"),
     MediaUrl0: Optional[str] = Form(default=None),
     MediaContentType0: Optional[str] = Form(default=None),
+    MessageSid: Optional[str] = Form(default=None),
 ):
     """
     Handle Twilio WhatsApp Webhook.
     POST /webhook/twilio
     
     Implements conversation state machine for print order flow.
+    Redelivered messages (same MessageSid) are acknowledged without
+    being processed again.
+    
+    Media is downloaded before the session row is locked, so the lock
+    (and its pooled connection) is never held across the Twilio download.
     """
     try:
         logger.info(f"Twilio message from {From}: '{Body}' (Media: {NumMedia})")
         
-        # Get or create user session
-        session = await session_service.get_or_create_session(db, From)
+        if MessageSid and not await twilio_service.claim_inbound_message(MessageSid):
+            logger.info(f"Duplicate Twilio message {MessageSid}, skipping")
+            return Response(content=_EMPTY_TWIML, media_type="application/xml")
         
         # Check if user sent a file
         has_media = int(NumMedia) > 0 and MediaUrl0
         
+        # Fetch the file before touching the database
+        upload, upload_error = (None, None)
+        if has_media:
+            upload, upload_error = await download_user_file(From, MediaUrl0)
+        
+        # Get or create user session (row stays locked until commit)
+        session = await session_service.get_or_create_session(db, From)
+        
         # Normalize message body
         message = Body.strip().lower()
         
@@ -61,22 +106,27 @@ async def handle_twilio_webhook(
             phone=From,
             message=message,
             has_media=has_media,
-            media_url=MediaUrl0,
-            media_type=MediaContentType0
+            upload=upload,
+            upload_error=upload_error
         )
         
+        # Persist the session changes from this turn
+        await db.commit()
+        
         # Create TwiML response
-        resp = MessagingResponse()
-        if response_text:
-            resp.message(response_text)
+        if not response_text:
+            content = _EMPTY_TWIML
+        else:
+            content = _STATIC_TWIML.get(response_text) or _render_twiml(response_text)
         
-        return Response(content=str(resp), media_type="application/xml")
+        return Response(content=content, media_type="application/xml")
         
     except Exception as e:
         logger.error(f"Error handling Twilio webhook: {e}", exc_info=True)
-        resp = MessagingResponse()
-        resp.message("Sorry, something went wrong. Please try again.")
-        return Response(content=str(resp), media_type="application/xml")
+        await db.rollback()
+        if MessageSid:
+            await twilio_service.release_inbound_message(MessageSid)
+        return Response(content=_STATIC_TWIML[MSG_ERROR], media_type="application/xml")
 
 
 async def process_message(
@@ -85,8 +135,8 @@ async def process_message(
     phone: str,
     message: str,
     has_media: bool,
-    media_url: Optional[str],
-    media_type: Optional[str]
+    upload: Optional[Tuple[str, str, str]] = None,
+    upload_error: Optional[str] = None
 ) -> str:
     """
     Process incoming message based on conversation state.
@@ -97,139 +147,156 @@ async def process_message(
     
     logger.info(f"Processing: state={current_state}, message='{message}', has_media={has_media}")
     
-    # ==========================================================================
-    # STATE: IDLE - Waiting for user to start
-    # ==========================================================================
-    if current_state == ConversationState.IDLE:
-        if has_media:
-            # User sent a file - process it
-            return await handle_file_upload(db, session, phone, media_url, media_type)
-        else:
-            # Any text message - send welcome
-            await session_service.update_session_state(db, session, ConversationState.AWAITING_FILE)
-            return twilio_service.msg_welcome()
+    # A file always (re)starts the order, whatever step the user was on
+    if has_media and current_state in _HANDLERS:
+        return await handle_file_upload(db, session, upload, upload_error)
     
-    # ==========================================================================
-    # STATE: AWAITING_FILE - Waiting for file upload
-    # ==========================================================================
-    elif current_state == ConversationState.AWAITING_FILE:
-        if has_media:
-            return await handle_file_upload(db, session, phone, media_url, media_type)
-        else:
-            return twilio_service.msg_welcome()
-    
-    # ==========================================================================
-    # STATE: AWAITING_PRINT_TYPE - Waiting for 1/2/3 selection
-    # ==========================================================================
-    elif current_state == ConversationState.AWAITING_PRINT_TYPE:
-        if has_media:
-            # User sent another file - start over with new file
-            return await handle_file_upload(db, session, phone, media_url, media_type)
-        
-        # Parse print type selection
-        print_type = parse_print_type_selection(message)
-        
-        if print_type:
-            await session_service.store_temp_print_type(db, session, print_type)
-            return twilio_service.msg_print_type_selected(print_type.value)
-        else:
-            return twilio_service.msg_invalid_input() + "\n\n" + twilio_service.msg_file_received(session.temp_file_name or "your file")
+    handler = _HANDLERS.get(current_state, _handle_unknown_state)
+    return await handler(db, session, phone, message)
+
+
+# ==========================================================================
+# STATE: IDLE - Waiting for user to start
+# ==========================================================================
+async def _handle_idle(db: AsyncSession, session, phone: str, message: str) -> str:
+    # Any text message - send welcome
+    await session_service.update_session_state(db, session, ConversationState.AWAITING_FILE)
+    return twilio_service.msg_welcome()
+
+
+# ==========================================================================
+# STATE: AWAITING_FILE - Waiting for file upload
+# ==========================================================================
+async def _handle_awaiting_file(db: AsyncSession, session, phone: str, message: str) -> str:
+    return twilio_service.msg_welcome()
+
+
+# ==========================================================================
+# STATE: AWAITING_PRINT_TYPE - Waiting for 1/2/3 selection
+# ==========================================================================
+async def _handle_awaiting_print_type(db: AsyncSession, session, phone: str, message: str) -> str:
+    print_type = parse_print_type_selection(message)
     
-    # ==========================================================================
-    # STATE: AWAITING_COPIES - Waiting for number of copies
-    # ==========================================================================
-    elif current_state == ConversationState.AWAITING_COPIES:
-        if has_media:
-            # User sent another file - start over
-            return await handle_file_upload(db, session, phone, media_url, media_type)
-        
-        # Parse copies number
-        copies = parse_copies_input(message)
-        
-        if copies:
-            return await finalize_order(db, session, phone, copies)
-        else:
-            return twilio_service.msg_invalid_copies()
+    if print_type:
+        await session_service.store_temp_print_type(db, session, print_type)
+        return twilio_service.msg_print_type_selected(print_type.value)
+    else:
+        return twilio_service.msg_invalid_input() + "\n\n" + twilio_service.msg_file_received(session.temp_file_name or "your file")
+
+
+# ==========================================================================
+# STATE: AWAITING_COPIES - Waiting for number of copies
+# ==========================================================================
+async def _handle_awaiting_copies(db: AsyncSession, session, phone: str, message: str) -> str:
+    copies = parse_copies_input(message)
     
-    # ==========================================================================
-    # STATE: AWAITING_PAYMENT - Payment link sent, waiting for confirmation
-    # ==========================================================================
-    elif current_state == ConversationState.AWAITING_PAYMENT:
-        if has_media:
-            # User sent another file - start new order
-            return await handle_file_upload(db, session, phone, media_url, media_type)
-        
-        # Check for cancel command
-        if message in ["cancel", "stop", "exit"]:
-            await session_service.clear_session(db, session)
-            return "Order cancelled. Send a document to start a new order."
-        
-        # Remind about payment
-        return (
-            "⏳ Waiting for payment...\n\n"
-            "Please complete payment using the link sent earlier.\n\n"
-            "_Reply 'cancel' to cancel this order._"
-        )
+    if copies:
+        return await finalize_order(db, session, phone, copies)
+    else:
+        return twilio_service.msg_invalid_copies()
+
+
+# ==========================================================================
+# STATE: AWAITING_PAYMENT - Payment link sent, waiting for confirmation
+# ==========================================================================
+async def _handle_awaiting_payment(db: AsyncSession, session, phone: str, message: str) -> str:
+    # Check for cancel command
+    if message in _CANCEL_COMMANDS:
+        await session_service.clear_session(db, session)
+        return MSG_ORDER_CANCELLED
     
+    # Remind about payment
+    return MSG_AWAITING_PAYMENT
+
+
+async def _handle_unknown_state(db: AsyncSession, session, phone: str, message: str) -> str:
     # Default fallback
     await session_service.update_session_state(db, session, ConversationState.IDLE)
     return twilio_service.msg_welcome()
 
 
-async def handle_file_upload(
-    db: AsyncSession,
-    session,
+_HANDLERS = {
+    ConversationState.IDLE: _handle_idle,
+    ConversationState.AWAITING_FILE: _handle_awaiting_file,
+    ConversationState.AWAITING_PRINT_TYPE: _handle_awaiting_print_type,
+    ConversationState.AWAITING_COPIES: _handle_awaiting_copies,
+    ConversationState.AWAITING_PAYMENT: _handle_awaiting_payment,
+}
+
+_CANCEL_COMMANDS = frozenset(["cancel", "stop", "exit"])
+
+
+async def download_user_file(
     phone: str,
-    media_url: str,
-    media_type: str
-) -> str:
+    media_url: str
+) -> Tuple[Optional[Tuple[str, str, str]], Optional[str]]:
     """
-    Handle file upload from user.
-    Downloads file, saves it, and updates session.
+    Download a file sent by the user and save it.
+    
+    Runs before the session is locked; makes no database calls.
+    
+    Returns:
+        ((filename, file_url, media_sid), None) on success,
+        (None, reply_text) when the file can't be used
     """
     try:
         # Extract media SID from URL for logging
         # Twilio URL format: https://api.twilio.com/2010-04-01/Accounts/{AccountSid}/Messages/{MessageSid}/Media/{MediaSid}
         media_sid = media_url.split("/")[-1] if media_url else "unknown"
         
-        # Download file from Twilio
-        result = await twilio_service.download_media_file(media_url, media_sid)
-        
-        if not result:
-            return "❌ Failed to download file. Please try sending it again."
-        
-        file_content, content_type, filename = result
-        
-        # Validate file type
-        if not is_supported_file_type(content_type):
-            return (
-                f"❌ Unsupported file type: {content_type}\n\n"
-                "_Supported: PDF, Word, Images (JPG, PNG)_"
-            )
-        
-        # Save file locally
-        file_path, file_url = await order_service.save_uploaded_file(
-            file_content=file_content,
-            filename=filename,
-            customer_phone=phone
-        )
-        
-        # Store in session
-        await session_service.store_temp_file(
-            db=db,
-            session=session,
-            file_url=file_url,
-            file_name=filename,
-            media_id=media_sid
-        )
+        # Stream file from Twilio straight to disk
+        try:
+            async with twilio_service.stream_media_file(media_url, media_sid) as (response, content_type, filename):
+                # Validate file type before reading the body
+                if not is_supported_file_type(content_type):
+                    return None, (
+                        f"❌ Unsupported file type: {content_type}\n\n"
+                        "_Supported: PDF, Word, Images (JPG, PNG)_"
+                    )
+                
+                file_path, file_url = await order_service.save_uploaded_stream(
+                    chunks=response.aiter_bytes(twilio_service.MEDIA_CHUNK_SIZE),
+                    filename=filename,
+                    customer_phone=phone
+                )
+        except Exception as e:
+            logger.error(f"Failed to download media {media_sid}: {e}")
+            return None, "❌ Failed to download file. Please try sending it again."
         
         logger.info(f"File uploaded: {filename} -> {file_url}")
         
-        return twilio_service.msg_file_received(filename)
+        return (filename, file_url, media_sid), None
         
     except Exception as e:
         logger.error(f"Error handling file upload: {e}", exc_info=True)
-        return "❌ Error processing file. Please try again."
+        return None, "❌ Error processing file. Please try again."
+
+
+async def handle_file_upload(
+    db: AsyncSession,
+    session,
+    upload: Optional[Tuple[str, str, str]],
+    upload_error: Optional[str]
+) -> str:
+    """
+    Handle file upload from user.
+    Stores the already downloaded file in the session.
+    """
+    if upload is None:
+        return upload_error or "❌ Error processing file. Please try again."
+    
+    filename, file_url, media_sid = upload
+    
+    # Store in session
+    await session_service.store_temp_file(
+        db=db,
+        session=session,
+        file_url=file_url,
+        file_name=filename,
+        media_id=media_sid
+    )
+    
+    return twilio_service.msg_file_received(filename)
 
 
 async def finalize_order(
@@ -240,6 +307,11 @@ async def finalize_order(
 ) -> str:
     """
     Finalize order with print configuration and generate payment link.
+    
+    The order is created and linked to the session, then committed before
+    Razorpay is called, so the session lock is released during the call.
+    Messages arriving meanwhile see AWAITING_PAYMENT. If the link can't be
+    created, the session goes back to copy selection.
     """
     try:
         # Create order from session data
@@ -263,27 +335,74 @@ async def finalize_order(
             copies=copies
         )
         
-        # Generate payment link
-        order, payment_url = await order_service.finalize_order_with_payment_link(db, order)
-        
-        # Link order to session
+        # Link order to session and release the lock
         await session_service.link_order_to_session(db, session, order)
-        
-        # Build response
-        summary = twilio_service.msg_order_summary(
-            filename=order.file_name,
-            print_type=order.print_type.value,
-            copies=order.copies,
-            amount=float(order.amount)
-        )
-        
-        payment_msg = twilio_service.msg_payment_link(payment_url)
-        
-        return f"{summary}\n\n{payment_msg}"
-        
+        await db.commit()
+        order_id = order.id
     except Exception as e:
         logger.error(f"Error finalizing order: {e}", exc_info=True)
+        await db.rollback()
         return "❌ Error creating order. Please try again."
+    
+    try:
+        # Generate payment link (no transaction open)
+        payment_url, payment_link_id = await order_service.request_payment_link(order)
+        
+        await order_service.attach_payment_link(db, order, payment_url, payment_link_id)
+    except Exception as e:
+        logger.error(f"Error creating payment link for order {order_id}: {e}", exc_info=True)
+        await db.rollback()
+        session = await session_service.get_or_create_session(db, phone)
+        await session_service.unlink_order_from_session(db, session, order_id)
+        return "❌ Error creating order. Please try again."
+    
+    # Build response
+    summary = twilio_service.msg_order_summary(
+        filename=order.file_name,
+        print_type=order.print_type.value,
+        copies=order.copies,
+        amount=float(order.amount)
+    )
+    
+    payment_msg = twilio_service.msg_payment_link(payment_url)
+    
+    return f"{summary}\n\n{payment_msg}"
+
+
+# Input aliases accepted at each step
+_PRINT_TYPE_CHOICES = {
+    # Number selections
+    "1": PrintType.COLOR, "one": PrintType.COLOR,
+    "2": PrintType.BW, "two": PrintType.BW,
+    "3": PrintType.BOTH, "three": PrintType.BOTH,
+    # Text selections
+    "color": PrintType.COLOR, "colour": PrintType.COLOR, "color xerox": PrintType.COLOR,
+    "colour xerox": PrintType.COLOR, "color print": PrintType.COLOR,
+    "bw": PrintType.BW, "b&w": PrintType.BW, "black": PrintType.BW,
+    "black and white": PrintType.BW, "black & white": PrintType.BW, "black white": PrintType.BW,
+    "both": PrintType.BOTH, "color and bw": PrintType.BOTH, "color + bw": PrintType.BOTH,
+    "all": PrintType.BOTH,
+}
+
+# Spelled numbers for copies
+_WORD_TO_NUM = {
+    "one": 1, "two": 2, "three": 3, "four": 4, "five": 5,
+    "six": 6, "seven": 7, "eight": 8, "nine": 9, "ten": 10
+}
+
+_SUPPORTED_TYPES = frozenset([
+    "application/pdf",
+    "image/jpeg",
+    "image/png",
+    "image/gif",
+    "application/msword",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "application/vnd.ms-excel",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "application/vnd.ms-powerpoint",
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+    "text/plain",
+])
 
 
 def parse_print_type_selection(message: str) -> Optional[PrintType]:
@@ -291,25 +410,7 @@ def parse_print_type_selection(message: str) -> Optional[PrintType]:
     Parse print type from user input.
     Accepts: 1/2/3, color/bw/both, or various aliases.
     """
-    message = message.strip().lower()
-    
-    # Number selections
-    if message in ["1", "one"]:
-        return PrintType.COLOR
-    elif message in ["2", "two"]:
-        return PrintType.BW
-    elif message in ["3", "three"]:
-        return PrintType.BOTH
-    
-    # Text selections
-    if message in ["color", "colour", "color xerox", "colour xerox", "color print"]:
-        return PrintType.COLOR
-    elif message in ["bw", "b&w", "black", "black and white", "black & white", "black white"]:
-        return PrintType.BW
-    elif message in ["both", "color and bw", "color + bw", "all"]:
-        return PrintType.BOTH
-    
-    return None
+    return _PRINT_TYPE_CHOICES.get(message.strip().lower())
 
 
 def parse_copies_input(message: str) -> Optional[int]:
@@ -317,46 +418,22 @@ def parse_copies_input(message: str) -> Optional[int]:
     Parse number of copies from user input.
     Returns None if invalid.
     """
-    message = message.strip()
+    message = message.strip().lower()
     
-    try:
-        # Handle spelled numbers
-        word_to_num = {
-            "one": 1, "two": 2, "three": 3, "four": 4, "five": 5,
-            "six": 6, "seven": 7, "eight": 8, "nine": 9, "ten": 10
-        }
-        
-        if message.lower() in word_to_num:
-            copies = word_to_num[message.lower()]
-        else:
-            copies = int(message)
-        
-        # Validate range
-        if 1 <= copies <= 100:
-            return copies
-        
-        return None
-        
-    except ValueError:
-        return None
+    copies = _WORD_TO_NUM.get(message)
+    if copies is None and message.isdecimal():
+        copies = int(message)
+    
+    # Validate range
+    if copies is not None and 1 <= copies <= 100:
+        return copies
+    
+    return None
 
 
 def is_supported_file_type(content_type: str) -> bool:
     """Check if file type is supported for printing."""
-    supported_types = [
-        "application/pdf",
-        "image/jpeg",
-        "image/png",
-        "image/gif",
-        "application/msword",
-        "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-        "application/vnd.ms-excel",
-        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        "application/vnd.ms-powerpoint",
-        "application/vnd.openxmlformats-officedocument.presentationml.presentation",
-        "text/plain",
-    ]
-    
     # Check main type (ignore parameters like charset)
-    main_type = content_type.split(";")[0].strip().lower()
-    return main_type in supported_types
+    end = content_type.find(";")
+    main_type = content_type if end < 0 else content_type[:end]
+    return main_type.strip().lower() in _SUPPORTED_TYPES
@@ -6,30 +6,48 @@ Handles:
 - Payment success callback
 """
 
-from fastapi import APIRouter, Request, Depends, HTTPException, Query
+from fastapi import APIRouter, Request, Depends, HTTPException, Query, BackgroundTasks
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
+from sqlalchemy import update, bindparam
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import load_only
 from decimal import Decimal
 from datetime import datetime
+from uuid import UUID
+from typing import Optional
+import asyncio
 import hashlib
 import logging
-import json
+import orjson
 
-from app.core.database import get_db
+from app.core.database import get_db, AsyncSessionLocal
 from app.models import (
     Order, Payment, PrintJob, PaymentStatus, OrderStatus, 
     PrintStatus, WebhookLog, UserSession, ConversationState
 )
-from app.services.razorpay_service import verify_webhook_signature
-from app.services.queue_service import enqueue_print_job
-from app.services import twilio_service, session_service
+from app.services.razorpay_service import read_verified_webhook_body
+from app.services.queue_service import queue_print_job, invalidate_job_cache
+from app.services import twilio_service, session_service, stats_service
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
+# Hot lookup built once; only the bound link ID changes per request.
+# Loads just the columns covered by ix_orders_plink_covering.
+_ORDER_BY_LINK = (
+    select(Order)
+    .options(load_only(Order.id, Order.order_status, Order.shop_id, Order.customer_phone))
+    .where(Order.razorpay_payment_link_id == bindparam("link_id"))
+)
+
 
 @router.post("/razorpay-webhook")
-async def razorpay_webhook(request: Request, db: AsyncSession = Depends(get_db)):
+async def razorpay_webhook(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    db: AsyncSession = Depends(get_db)
+):
     """
     Handle Razorpay Webhooks.
     
@@ -42,31 +60,49 @@ async def razorpay_webhook(request: Request, db: AsyncSession = Depends(get_db))
     Security:
     - HMAC signature verification
     - Idempotent processing (prevents duplicate handling)
+    
+    The event is processed before the response is sent. The idempotency
+    claim commits together with the handler's writes, so a crash mid-way
+    leaves nothing behind, and any failure returns 500 so Razorpay
+    redelivers the event.
     """
     try:
-        body = await request.body()
         signature = request.headers.get("X-Razorpay-Signature")
         
-        # 1. Verify webhook signature
-        if not verify_webhook_signature(body, signature):
+        # 1. Verify webhook signature while the body streams in
+        body = await read_verified_webhook_body(request.stream(), signature)
+        if body is None:
             logger.warning("Invalid Razorpay Signature")
             raise HTTPException(status_code=400, detail="Invalid Signature")
         
-        event = json.loads(body)
+        event = orjson.loads(body)
         event_type = event.get("event")
         payload = event.get("payload", {})
         
+        # Hash the payload once; it backs both the fallback event ID and the log
+        body_digest = hashlib.sha256(body).digest()
+        
         # Generate event ID for idempotency
         # Razorpay doesn't always provide a unique event ID, so we hash the payload
-        event_id = event.get("event_id") or hashlib.sha256(body).hexdigest()[:32]
+        event_id = event.get("event_id") or body_digest[:16].hex()
         
         logger.info(f"Received Razorpay Event: {event_type}, ID: {event_id}")
         
-        # 2. Check idempotency - have we processed this event?
-        existing = await db.execute(
-            select(WebhookLog).where(WebhookLog.event_id == event_id)
+        # 2. Claim the event. ON CONFLICT makes the check and the log insert a
+        #    single atomic statement, so concurrent redeliveries can't both
+        #    proceed. The row commits together with the handler's writes.
+        claimed = await db.execute(
+            pg_insert(WebhookLog)
+            .values(
+                event_id=event_id,
+                event_type=event_type,
+                provider="razorpay",
+                payload_hash=body_digest.hex()
+            )
+            .on_conflict_do_nothing(index_elements=[WebhookLog.event_id])
+            .returning(WebhookLog.id)
         )
-        if existing.scalars().first():
+        if claimed.first() is None:
             logger.info(f"Event {event_id} already processed, skipping")
             return {"status": "already_processed"}
         
@@ -74,36 +110,54 @@ async def razorpay_webhook(request: Request, db: AsyncSession = Depends(get_db))
         result = {"status": "ignored"}
         
         if event_type == "payment_link.paid":
-            result = await handle_payment_link_paid(db, payload)
+            result = await handle_payment_link_paid(db, payload, background_tasks)
         elif event_type == "payment.captured":
             result = await handle_payment_captured(db, payload)
         
-        # 4. Log successful processing
-        webhook_log = WebhookLog(
-            event_id=event_id,
-            event_type=event_type,
-            provider="razorpay",
-            payload_hash=hashlib.sha256(body).hexdigest()
-        )
-        db.add(webhook_log)
+        # Persist the log for events the handler didn't commit itself
+        # (no-op when it already did)
         await db.commit()
         
+        logger.info(f"Processed Razorpay event {event_id}: {result.get('status')}")
         return result
         
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"Error processing Razorpay webhook: {e}", exc_info=True)
-        # Return 200 to prevent Razorpay from retrying on logic errors
-        # For genuine server errors, you might want 500
-        return {"status": "error", "detail": str(e)}
+        await db.rollback()
+        # Nothing was committed; a 5xx makes Razorpay redeliver the event
+        raise HTTPException(status_code=500, detail="Webhook processing failed")
 
 
-async def handle_payment_link_paid(db: AsyncSession, payload: dict) -> dict:
+def _parse_reference_id(reference_id: str) -> Optional[UUID]:
+    """
+    Parse a payment link reference_id back into an order UUID.
+    
+    New links carry the 32-char hex form, which maps straight onto the
+    UUID bytes; links created before that carry the dashed string form.
+    """
+    try:
+        if len(reference_id) == 32:
+            return UUID(bytes=bytes.fromhex(reference_id))
+        return UUID(reference_id)
+    except ValueError:
+        return None
+
+
+async def handle_payment_link_paid(
+    db: AsyncSession,
+    payload: dict,
+    background_tasks: BackgroundTasks
+) -> dict:
     """
     Handle payment_link.paid event.
     
     This is the primary event we receive when using Razorpay Payment Links.
+    The order, payment and print job are committed before the webhook
+    responds. The Redis enqueue is handed to the batcher (the queue sweeper
+    covers a failed push) and the WhatsApp confirmation is sent after the
+    response.
     
     Payload structure:
     {
@@ -127,23 +181,15 @@ async def handle_payment_link_paid(db: AsyncSession, payload: dict) -> dict:
             return {"status": "error", "detail": "missing_payment_link_id"}
         
         # Find order by payment link ID
-        result = await db.execute(
-            select(Order).where(Order.razorpay_payment_link_id == payment_link_id)
-        )
+        result = await db.execute(_ORDER_BY_LINK, {"link_id": payment_link_id})
         order = result.scalars().first()
         
         if not order:
             # Fallback: try reference_id which should be order UUID
             if reference_id:
-                try:
-                    import uuid
-                    order_uuid = uuid.UUID(reference_id)
-                    result = await db.execute(
-                        select(Order).where(Order.id == order_uuid)
-                    )
-                    order = result.scalars().first()
-                except ValueError:
-                    pass
+                order_uuid = _parse_reference_id(reference_id)
+                if order_uuid:
+                    order = await db.get(Order, order_uuid)
         
         if not order:
             logger.error(f"Order not found for payment_link_id: {payment_link_id}")
@@ -156,54 +202,79 @@ async def handle_payment_link_paid(db: AsyncSession, payload: dict) -> dict:
         
         # === BEGIN TRANSACTION ===
         
-        # 1. Update payment record
+        # 1. Flip order to PAID. The status guard makes this the idempotency
+        #    gate: a concurrent retry blocks on the row lock, then matches nothing.
         result = await db.execute(
-            select(Payment).where(Payment.order_id == order.id)
+            update(Order)
+            .where(Order.id == order.id, Order.order_status != OrderStatus.PAID)
+            .values(order_status=OrderStatus.PAID)
+            .returning(Order.id)
         )
-        payment = result.scalars().first()
-        
-        if payment:
-            payment.payment_status = PaymentStatus.SUCCESS
-            payment.provider_reference = razorpay_payment_id
-            payment.paid_at = datetime.utcnow()
-        else:
-            # Create payment record if missing
-            payment = Payment(
+        if result.first() is None:
+            # Nothing else written yet; keep the event claim
+            await db.commit()
+            logger.info(f"Order {order.id} already paid")
+            return {"status": "already_paid"}
+        
+        # 2. Upsert payment record (created when the link was generated)
+        paid_at = datetime.utcnow()
+        await db.execute(
+            pg_insert(Payment)
+            .values(
                 order_id=order.id,
                 payment_link_id=payment_link_id,
                 provider_reference=razorpay_payment_id,
                 amount=amount_paid,
                 payment_status=PaymentStatus.SUCCESS,
-                paid_at=datetime.utcnow()
+                paid_at=paid_at
             )
-            db.add(payment)
-        
-        # 2. Update order status
-        order.order_status = OrderStatus.PAID
+            .on_conflict_do_update(
+                index_elements=[Payment.order_id],
+                set_={
+                    "payment_status": PaymentStatus.SUCCESS,
+                    "provider_reference": razorpay_payment_id,
+                    "paid_at": paid_at
+                }
+            )
+        )
         
-        # 3. Create print job
-        print_job = PrintJob(
-            order_id=order.id,
-            shop_id=order.shop_id,
-            print_status=PrintStatus.QUEUED
+        # 3. Create print job (one per order, enforced by the unique constraint)
+        result = await db.execute(
+            pg_insert(PrintJob)
+            .values(
+                order_id=order.id,
+                shop_id=order.shop_id,
+                print_status=PrintStatus.QUEUED
+            )
+            .on_conflict_do_nothing(index_elements=[PrintJob.order_id])
+            .returning(PrintJob.id)
         )
-        db.add(print_job)
+        print_job_id = result.scalar_one_or_none()
         
         # Commit all changes atomically
         await db.commit()
-        await db.refresh(print_job)
         
         # === END TRANSACTION ===
         
-        # 4. Enqueue print job to Redis
-        enqueue_print_job(str(print_job.id))
+        # Paid orders change revenue - drop cached dashboard stats
+        await stats_service.invalidate_stats_cache(order.shop_id)
+        
+        if print_job_id is None:
+            logger.warning(f"Print job already exists for order {order.id}")
+            return {"status": "already_queued", "order_id": str(order.id)}
+        
+        # New job - cached job listings no longer match
+        await invalidate_job_cache()
         
-        logger.info(f"Order {order.id} paid. Print job {print_job.id} queued.")
+        # 4. Enqueue print job to Redis (batched with other webhooks in flight)
+        await queue_print_job(str(print_job_id))
         
-        # 5. Send WhatsApp confirmation to customer
-        await send_payment_confirmation(db, order)
+        logger.info(f"Order {order.id} paid. Print job {print_job_id} queued.")
         
-        return {"status": "success", "order_id": str(order.id), "print_job_id": str(print_job.id)}
+        # 5. Send WhatsApp confirmation to customer after responding
+        background_tasks.add_task(send_payment_confirmation, order.id, order.customer_phone)
+        
+        return {"status": "success", "order_id": str(order.id), "print_job_id": str(print_job_id)}
         
     except Exception as e:
         logger.error(f"Error handling payment_link.paid: {e}", exc_info=True)
@@ -240,29 +311,40 @@ async def handle_payment_captured(db: AsyncSession, payload: dict) -> dict:
         return {"status": "error"}
 
 
-async def send_payment_confirmation(db: AsyncSession, order: Order):
+async def send_payment_confirmation(order_id: UUID, customer_phone: str):
     """
     Send WhatsApp notification to customer after payment success.
     Also updates conversation state.
+    
+    Opens its own database session for the reset, so it can run
+    alongside the send.
     """
     try:
-        # Send confirmation message
-        await twilio_service.send_whatsapp_message(
-            to=order.customer_phone,
-            body=twilio_service.msg_payment_success(str(order.id))
+        # Send the confirmation and clear the user session concurrently;
+        # neither depends on the other
+        await asyncio.gather(
+            twilio_service.send_whatsapp_message(
+                to=customer_phone,
+                body=twilio_service.msg_payment_success(str(order_id))
+            ),
+            _clear_customer_session(customer_phone)
         )
         
-        # Clear user session
-        session = await session_service.get_session_by_phone(db, order.customer_phone)
-        if session:
-            await session_service.clear_session(db, session)
-        
-        logger.info(f"Payment confirmation sent to {order.customer_phone}")
+        logger.info(f"Payment confirmation sent to {customer_phone}")
         
     except Exception as e:
         logger.error(f"Failed to send payment confirmation: {e}")
 
 
+async def _clear_customer_session(customer_phone: str):
+    """Reset the customer's conversation state in its own session."""
+    async with AsyncSessionLocal() as db:
+        session = await session_service.get_session_by_phone(db, customer_phone)
+        if session:
+            await session_service.clear_session(db, session)
+            await db.commit()
+
+
 @router.get("/razorpay-callback")
 async def razorpay_callback(
     razorpay_payment_id: str = Query(None),
@@ -1,11 +1,8 @@
 from pydantic_settings import BaseSettings
 from functools import lru_cache
-from dotenv import load_dotenv
 from typing import Optional
 import os
 
-load_dotenv()
-
 
 class Settings(BaseSettings):
     API_V1_STR: str = "/api/v1"
@@ -13,6 +10,11 @@ class Settings(BaseSettings):
     
     # Database
     DATABASE_URL: str
+    # Connection pool (per process; sized for bursty webhook traffic)
+    DB_POOL_SIZE: int = 20
+    DB_MAX_OVERFLOW: int = 40
+    DB_POOL_TIMEOUT: int = 30  # Seconds to wait for a free connection
+    DB_POOL_RECYCLE: int = 1800
     
     # Redis
     REDIS_URL: str = "redis://localhost:6379/0"
@@ -36,6 +38,9 @@ class Settings(BaseSettings):
     
     # File storage
     FILE_STORAGE_PATH: str = "./uploads"
+    # Internal nginx location aliased to FILE_STORAGE_PATH (e.g. "/internal/files/").
+    # When set, file downloads are handed to nginx via X-Accel-Redirect.
+    FILE_ACCEL_REDIRECT_PREFIX: Optional[str] = None
     
     # Printer
     PRINTER_NAME: str = "Default_Printer"
@@ -46,6 +51,12 @@ class Settings(BaseSettings):
     # Pricing defaults (in INR)
     PRICE_PER_PAGE_BW: float = 2.0
     PRICE_PER_PAGE_COLOR: float = 10.0
+    
+    # Dashboard rollup refresh interval (seconds)
+    STATS_REFRESH_INTERVAL_SECONDS: int = 300
+    
+    # Stale print job sweep interval (seconds)
+    QUEUE_SWEEP_INTERVAL_SECONDS: int = 60
 
     class Config:
         env_file = ".env"
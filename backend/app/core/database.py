@@ -1,16 +1,37 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker, declarative_base
+import logging
+from typing import Optional
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession, AsyncConnection
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from app.core.config import get_settings
 
 settings = get_settings()
+logger = logging.getLogger(__name__)
 
 engine = create_async_engine(
     settings.DATABASE_URL,
     echo=True, # Set to False in production
-    future=True
+    future=True,
+    # Sized for bursty dashboard polling and webhook traffic (see DB_POOL_* settings)
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_timeout=settings.DB_POOL_TIMEOUT,
+    pool_pre_ping=True,  # Drop connections that died during idle periods
+    pool_recycle=settings.DB_POOL_RECYCLE,
+    pool_use_lifo=True,  # Reuse the most recent connection; lets idle extras age out
+    connect_args={"statement_cache_size": 1024}  # asyncpg prepared statements
 )
 
-AsyncSessionLocal = sessionmaker(
+@event.listens_for(engine.sync_engine.pool, "checkout")
+def _warn_on_pool_exhaustion(dbapi_connection, connection_record, connection_proxy):
+    """Log when a checkout takes the last connection the pool can hand out."""
+    pool = engine.sync_engine.pool
+    if pool.checkedout() >= settings.DB_POOL_SIZE + settings.DB_MAX_OVERFLOW:
+        logger.warning(f"DB pool exhausted: {pool.status()}")
+
+AsyncSessionLocal = async_sessionmaker(
     engine, class_=AsyncSession, expire_on_commit=False
 )
 
@@ -22,3 +43,76 @@ async def get_db():
             yield session
         finally:
             await session.close()
+
+
+# Advisory lock keys for background loops that must run in one process only
+STATS_REFRESH_LOCK_KEY = 0x414D504B01
+QUEUE_SWEEP_LOCK_KEY = 0x414D504B02
+
+class AdvisoryLeader:
+    """
+    Elects a single process (across gunicorn workers and hosts) to run a
+    background loop.
+    
+    The leader holds a session-level pg_try_advisory_lock on a dedicated
+    connection. Other processes retry on each tick, so one takes over when
+    the leader exits or loses its connection.
+    """
+    
+    def __init__(self, lock_key: int):
+        self.lock_key = lock_key
+        self._conn: Optional[AsyncConnection] = None
+    
+    async def acquire(self) -> bool:
+        """Return True if this process holds the lock (taking it if free)."""
+        if self._conn is not None:
+            try:
+                # A dead connection means the lock went with it
+                await self._conn.execute(text("SELECT 1"))
+                await self._conn.commit()
+                return True
+            except Exception as e:
+                logger.warning(f"Lost advisory lock {self.lock_key}: {e}")
+                await self._drop_connection()
+        
+        conn = await engine.connect()
+        try:
+            acquired = (await conn.execute(
+                text("SELECT pg_try_advisory_lock(:key)"), {"key": self.lock_key}
+            )).scalar()
+            await conn.commit()  # Don't sit idle in a transaction
+        except Exception:
+            await conn.close()
+            raise
+        
+        if not acquired:
+            await conn.close()
+            return False
+        
+        self._conn = conn
+        logger.info(f"Acquired advisory lock {self.lock_key}")
+        return True
+    
+    async def release(self):
+        """Give up the lock, e.g. on shutdown."""
+        if self._conn is None:
+            return
+        try:
+            await self._conn.execute(
+                text("SELECT pg_advisory_unlock(:key)"), {"key": self.lock_key}
+            )
+            await self._conn.commit()
+            await self._conn.close()
+            self._conn = None
+        except Exception:
+            await self._drop_connection()
+    
+    async def _drop_connection(self):
+        # Invalidate rather than return it to the pool, so a session-level
+        # lock can never linger on a pooled connection
+        try:
+            await self._conn.invalidate()
+            await self._conn.close()
+        except Exception:
+            pass
+        self._conn = None
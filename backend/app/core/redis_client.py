@@ -1,11 +1,28 @@
-import redis
+import redis.asyncio as aioredis
 from app.core.config import get_settings
 
 settings = get_settings()
 
-# Initialize Redis Client
-# Decode responses to get strings instead of bytes
-redis_client = redis.from_url(settings.REDIS_URL, decode_responses=True) if hasattr(settings, 'REDIS_URL') else redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
+# Seconds a command waits for a free pooled connection before failing
+REDIS_POOL_TIMEOUT_SECONDS = 5
+
+# Initialize Redis Client (asyncio, so calls never block the event loop)
+# Decode responses to get strings instead of bytes. The blocking pool makes
+# bursts past 50 in-flight commands wait for a connection instead of raising
+# MaxConnectionsError.
+# from_pool hands the pool to the client, so aclose() disconnects it too.
+redis_client = aioredis.Redis.from_pool(
+    aioredis.BlockingConnectionPool.from_url(
+        settings.REDIS_URL,
+        decode_responses=True,
+        max_connections=50,
+        timeout=REDIS_POOL_TIMEOUT_SECONDS
+    )
+)
 
 def get_redis_client():
     return redis_client
+
+async def close_redis_client():
+    """Close the connection pool (called on application shutdown)."""
+    await redis_client.aclose()
@@ -4,15 +4,21 @@ AMP K - Automated Print System Backend
 Main FastAPI application entry point.
 """
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from contextlib import asynccontextmanager
+import asyncio
 import logging
 import os
+import time
+import orjson
 
 from app.api.routes import twilio, webhooks, print_jobs, dashboard, files
 from app.core.config import get_settings
 from app.core.database import engine, Base
+from app.core.redis_client import close_redis_client
+from app.services import stats_service, queue_service, twilio_service, razorpay_service
 
 # Configure Logging
 logging.basicConfig(
@@ -47,6 +53,17 @@ async def lifespan(app: FastAPI):
         await conn.run_sync(Base.metadata.create_all)
     logger.info("Database tables initialized.")
     
+    # Open pool connections now rather than during the first burst
+    await warm_db_pool()
+    
+    # Create dashboard rollup view
+    try:
+        async with engine.begin() as conn:
+            await stats_service.ensure_daily_stats_view(conn)
+        logger.info("Dashboard stats view initialized.")
+    except Exception as e:
+        logger.error(f"Error creating dashboard stats view: {e}")
+    
     # Create uploads directory
     os.makedirs(settings.FILE_STORAGE_PATH, exist_ok=True)
     logger.info(f"Upload directory: {os.path.abspath(settings.FILE_STORAGE_PATH)}")
@@ -55,19 +72,57 @@ async def lifespan(app: FastAPI):
     if settings.DEFAULT_SHOP_ID:
         await ensure_default_shop()
     
+    # Keep the dashboard rollup fresh in the background
+    stats_refresh_task = asyncio.create_task(stats_service.run_refresh_loop())
+    
+    # Re-queue print jobs whose Redis push was lost
+    queue_sweeper_task = asyncio.create_task(queue_service.run_sweeper_loop())
+    
+    # Coalesce print job pushes from concurrent webhooks
+    enqueue_batcher_task = asyncio.create_task(queue_service.run_enqueue_batcher())
+    
     logger.info("AMP K Backend started successfully!")
     
     yield  # Application runs here
     
     # === SHUTDOWN ===
     logger.info("Shutting down AMP K Backend...")
+    stats_refresh_task.cancel()
+    queue_sweeper_task.cancel()
+    enqueue_batcher_task.cancel()
+    await asyncio.gather(enqueue_batcher_task, return_exceptions=True)  # Let it flush
+    await asyncio.gather(stats_refresh_task, queue_sweeper_task, return_exceptions=True)  # Let them drop their advisory locks
+    await twilio_service.close_http_client()
+    await razorpay_service.close_http_client()
+    await close_redis_client()
+    logger.info(f"DB pool at shutdown: {engine.pool.status()}")
+
+
+async def warm_db_pool():
+    """
+    Open every pooled connection up front.
+    
+    Each connection is checked out concurrently so the pool fills to
+    pool_size; failures are logged and left to lazy connects.
+    """
+    from sqlalchemy import text
+    
+    async def _warm():
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+    
+    try:
+        await asyncio.gather(*[_warm() for _ in range(engine.pool.size())])
+        logger.info(f"Warmed DB pool: {engine.pool.status()}")
+    except Exception as e:
+        logger.error(f"Error warming DB pool: {e}")
 
 
 async def ensure_default_shop():
     """
     Ensure default shop exists in database.
     """
-    from sqlalchemy.future import select
+    from sqlalchemy.dialects.postgresql import insert as pg_insert
     from app.core.database import AsyncSessionLocal
     from app.models import Shop
     import uuid
@@ -76,16 +131,22 @@ async def ensure_default_shop():
         shop_id = uuid.UUID(settings.DEFAULT_SHOP_ID)
         
         async with AsyncSessionLocal() as db:
-            result = await db.execute(select(Shop).where(Shop.id == shop_id))
-            if not result.scalars().first():
-                shop = Shop(
+            # Single race-free upsert; several workers may start at once
+            result = await db.execute(
+                pg_insert(Shop)
+                .values(
                     id=shop_id,
                     name="Default Shop",
                     location="Main Location",
                     is_active=True
                 )
-                db.add(shop)
-                await db.commit()
+                .on_conflict_do_nothing(index_elements=[Shop.id])
+                .returning(Shop.id)
+            )
+            created = result.first() is not None
+            await db.commit()
+            
+            if created:
                 logger.info(f"Created default shop: {shop_id}")
             else:
                 logger.info(f"Default shop exists: {shop_id}")
@@ -99,6 +160,7 @@ app = FastAPI(
     title=settings.PROJECT_NAME,
     description="WhatsApp-based automated printing system",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
     lifespan=lifespan
 )
 
@@ -155,14 +217,23 @@ app.include_router(
 # HEALTH CHECK
 # =============================================================================
 
+# Root payload never changes - serialize it once
+_ROOT_BODY = orjson.dumps({
+    "service": "AMP K Backend",
+    "status": "running",
+    "version": "1.0.0"
+})
+
+
 @app.get("/", tags=["Health"])
-def root():
+async def root():
     """Root endpoint - health check."""
-    return {
-        "service": "AMP K Backend",
-        "status": "running",
-        "version": "1.0.0"
-    }
+    return Response(content=_ROOT_BODY, media_type="application/json")
+
+
+# Probes hit /health every few seconds; reuse the last result briefly
+HEALTH_CACHE_TTL_SECONDS = 2.0
+_health_cache = {"ts": 0.0, "val": None}
 
 
 @app.get("/health", tags=["Health"])
@@ -170,7 +241,14 @@ async def health_check():
     """
     Detailed health check endpoint.
     Checks database and Redis connectivity.
+    
+    The result is cached for HEALTH_CACHE_TTL_SECONDS so frequent probes
+    don't each take a pool connection and a Redis round trip.
     """
+    if time.monotonic() - _health_cache["ts"] < HEALTH_CACHE_TTL_SECONDS:
+        return _health_cache["val"]
+    
+    from sqlalchemy import text
     from app.core.redis_client import get_redis_client
     from app.core.database import AsyncSessionLocal
     
@@ -183,7 +261,7 @@ async def health_check():
     # Check database
     try:
         async with AsyncSessionLocal() as db:
-            await db.execute("SELECT 1")
+            await db.execute(text("SELECT 1"))
         health["database"] = "connected"
     except Exception as e:
         health["database"] = f"error: {str(e)}"
@@ -192,10 +270,12 @@ async def health_check():
     # Check Redis
     try:
         redis = get_redis_client()
-        redis.ping()
+        await redis.ping()
         health["redis"] = "connected"
     except Exception as e:
         health["redis"] = f"error: {str(e)}"
         health["status"] = "degraded"
     
+    _health_cache["ts"] = time.monotonic()
+    _health_cache["val"] = health
     return health
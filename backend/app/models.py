@@ -1,7 +1,9 @@
+import os
+import time
 import uuid
 from datetime import datetime
 import enum
-from sqlalchemy import Column, String, Integer, DateTime, Enum, Text, ForeignKey, Boolean, Numeric, Index
+from sqlalchemy import Column, String, Integer, DateTime, Enum, Text, ForeignKey, Boolean, Numeric, Index, text
 from sqlalchemy.orm import relationship
 from sqlalchemy.dialects.postgresql import UUID
 from app.core.database import Base
@@ -42,6 +44,25 @@ class ConversationState(str, enum.Enum):
     AWAITING_PAYMENT = "AWAITING_PAYMENT"   # Payment link sent, waiting
 
 
+def _enum_values(enum_cls):
+    """Store enum values (not member names) in the native Postgres enum."""
+    return [member.value for member in enum_cls]
+
+
+def uuid7() -> uuid.UUID:
+    """
+    Time-ordered UUID (RFC 9562 version 7).
+    
+    The leading 48 bits are the Unix time in milliseconds, so new keys land
+    at the right edge of the primary key B-tree instead of on random pages.
+    """
+    value = (time.time_ns() // 1_000_000) << 80
+    value |= int.from_bytes(os.urandom(10), "big")
+    value &= ~(0xF << 76) & ~(0x3 << 62)  # Clear version and variant bits
+    value |= (0x7 << 76) | (0x2 << 62)
+    return uuid.UUID(int=value)
+
+
 # =============================================================================
 # MODELS
 # =============================================================================
@@ -49,7 +70,7 @@ class ConversationState(str, enum.Enum):
 class Shop(Base):
     __tablename__ = "shops"
 
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid7)
     name = Column(String(255), nullable=False)
     location = Column(Text)
     is_active = Column(Boolean, default=True)
@@ -67,7 +88,7 @@ class Shop(Base):
 class Order(Base):
     __tablename__ = "orders"
 
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid7)
     customer_phone = Column(String(50), nullable=False, index=True)
     
     # File info
@@ -78,18 +99,18 @@ class Order(Base):
     page_count = Column(Integer, default=1)   # Number of pages in document
     
     # Print configuration
-    print_type = Column(Enum(PrintType))      # COLOR, BW, BOTH
+    print_type = Column(Enum(PrintType, values_callable=_enum_values))  # COLOR, BW, BOTH
     copies = Column(Integer, default=1)
     
     # Pricing
     amount = Column(Numeric(10, 2), default=0)
     
     # Razorpay binding
-    razorpay_payment_link_id = Column(String(255), unique=True, index=True)
+    razorpay_payment_link_id = Column(String(255))  # Unique via ix_orders_plink_covering
     razorpay_payment_link_url = Column(Text)
     
     # Status
-    order_status = Column(Enum(OrderStatus), nullable=False, default=OrderStatus.DRAFT)
+    order_status = Column(Enum(OrderStatus, values_callable=_enum_values), nullable=False, default=OrderStatus.DRAFT)
     
     # Shop reference
     shop_id = Column(UUID(as_uuid=True), ForeignKey("shops.id", ondelete="SET NULL"))
@@ -100,25 +121,34 @@ class Order(Base):
 
     # Relationships
     shop = relationship("Shop", back_populates="orders")
-    payment = relationship("Payment", back_populates="order", uselist=False, cascade="all, delete-orphan")
-    print_job = relationship("PrintJob", back_populates="order", uselist=False, cascade="all, delete-orphan")
+    # lazy="raise": load these explicitly; an implicit lazy load can't run under asyncio
+    payment = relationship("Payment", back_populates="order", uselist=False, cascade="all, delete-orphan", lazy="raise")
+    print_job = relationship("PrintJob", back_populates="order", uselist=False, cascade="all, delete-orphan", lazy="raise")
 
     __table_args__ = (
         Index('idx_orders_shop_status', 'shop_id', 'order_status'),
+        Index('idx_orders_created_id', created_at.desc(), id.desc()),  # Keyset pagination
+        Index('idx_orders_shop_created', 'shop_id', created_at.desc()),
+        # Paid-webhook lookup by payment link, answered by an index-only scan
+        Index('ix_orders_plink_covering', 'razorpay_payment_link_id', unique=True,
+              postgresql_include=['id', 'order_status', 'shop_id', 'customer_phone']),
+        # Dashboard revenue windows only ever look at PAID orders
+        Index('idx_orders_paid_updated', 'shop_id', updated_at.desc(),
+              postgresql_where=text("order_status = 'PAID'")),
     )
 
 
 class Payment(Base):
     __tablename__ = "payments"
 
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid7)
     order_id = Column(UUID(as_uuid=True), ForeignKey("orders.id", ondelete="CASCADE"), nullable=False, unique=True)
     
     # Razorpay reference
     provider_reference = Column(String(255))          # razorpay_payment_id
     payment_link_id = Column(String(255), index=True) # plink_xxx for lookup
     
-    payment_status = Column(Enum(PaymentStatus), default=PaymentStatus.INITIATED)
+    payment_status = Column(Enum(PaymentStatus, values_callable=_enum_values), default=PaymentStatus.INITIATED)
     amount = Column(Numeric(10, 2), nullable=False)
     
     paid_at = Column(DateTime)
@@ -135,12 +165,12 @@ class Payment(Base):
 class PrintJob(Base):
     __tablename__ = "print_jobs"
 
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid7)
     order_id = Column(UUID(as_uuid=True), ForeignKey("orders.id", ondelete="CASCADE"), nullable=False, unique=True)
     shop_id = Column(UUID(as_uuid=True), ForeignKey("shops.id"), nullable=False)
     
     printer_name = Column(String(100))
-    print_status = Column(Enum(PrintStatus), default=PrintStatus.QUEUED)
+    print_status = Column(Enum(PrintStatus, values_callable=_enum_values), default=PrintStatus.QUEUED)
     
     # Retry handling
     retry_count = Column(Integer, default=0)
@@ -156,7 +186,11 @@ class PrintJob(Base):
     shop = relationship("Shop", back_populates="print_jobs")
 
     __table_args__ = (
-        Index('idx_print_jobs_queue', 'shop_id', 'print_status', 'created_at'),
+        # Covering index for the job listing (index-only scan)
+        Index('idx_print_jobs_shop_status_created', 'shop_id', 'print_status', created_at.desc(),
+              postgresql_include=['id', 'order_id', 'retry_count', 'printed_at']),
+        Index('idx_print_jobs_failed_updated', 'shop_id', updated_at.desc(),
+              postgresql_where=text("print_status = 'FAILED'")),
     )
 
 
@@ -167,11 +201,11 @@ class UserSession(Base):
     """
     __tablename__ = "user_sessions"
 
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid7)
     phone = Column(String(50), nullable=False, unique=True, index=True)
     
     # Current conversation state
-    state = Column(Enum(ConversationState), default=ConversationState.IDLE)
+    state = Column(Enum(ConversationState, values_callable=_enum_values), default=ConversationState.IDLE)
     
     # Draft order being built (nullable until order is created)
     draft_order_id = Column(UUID(as_uuid=True), ForeignKey("orders.id", ondelete="SET NULL"))
@@ -180,7 +214,7 @@ class UserSession(Base):
     temp_file_url = Column(Text)
     temp_file_name = Column(Text)
     temp_file_media_id = Column(String(255))
-    temp_print_type = Column(Enum(PrintType))
+    temp_print_type = Column(Enum(PrintType, values_callable=_enum_values))
     
     # Session timing
     last_activity = Column(DateTime, default=datetime.utcnow)
@@ -189,6 +223,12 @@ class UserSession(Base):
     # Relationships
     draft_order = relationship("Order", foreign_keys=[draft_order_id])
 
+    __table_args__ = (
+        # FK index so ON DELETE SET NULL doesn't scan every session
+        Index('idx_user_sessions_draft_order', 'draft_order_id',
+              postgresql_where=text("draft_order_id IS NOT NULL")),
+    )
+
 
 class WebhookLog(Base):
     """
@@ -197,7 +237,7 @@ class WebhookLog(Base):
     """
     __tablename__ = "webhook_logs"
 
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid7)
     
     # Unique identifier from provider (e.g., razorpay event id)
     event_id = Column(String(255), unique=True, nullable=False, index=True)
@@ -7,6 +7,7 @@ Business logic layer for:
 - Session/conversation state
 - WhatsApp messaging (Twilio)
 - Redis queue operations
+- Dashboard statistics rollup
 """
 
 from app.services import (
@@ -15,6 +16,7 @@ from app.services import (
     session_service,
     twilio_service,
     queue_service,
+    stats_service,
 )
 
 __all__ = [
@@ -23,4 +25,5 @@ __all__ = [
     "session_service",
     "twilio_service",
     "queue_service",
+    "stats_service",
 ]
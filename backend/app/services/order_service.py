@@ -2,17 +2,30 @@
 Order Service for AMP K
 
 Handles order creation, price calculation, and lifecycle management.
+
+The helpers used by the WhatsApp flow only flush; the webhook commits
+them together with the session changes, and commits before any call to
+Razorpay so no row lock is held across it.
+
+Nothing is refreshed after a write: column defaults are generated in
+Python, so the objects hold what was written. The exception is
+updated_at, which the touch_updated_at trigger in schema.sql rewrites
+server-side. The in-memory value is stale after an update, so don't read
+it after a write; query the row again when it's needed.
 """
 
+import asyncio
 import uuid
 import hashlib
 import os
+import aiofiles
 from datetime import datetime
-from typing import Optional, Tuple
+from typing import Optional, Tuple, AsyncIterator
 from decimal import Decimal
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from sqlalchemy import and_
+from sqlalchemy.orm import joinedload
 
 from app.models import (
     Order, OrderStatus, Payment, PaymentStatus, 
@@ -25,11 +38,24 @@ import logging
 settings = get_settings()
 logger = logging.getLogger(__name__)
 
+# Write/hash granularity for uploads
+FILE_CHUNK_SIZE = 256 * 1024
+
 
 # =============================================================================
 # PRICE CALCULATION
 # =============================================================================
 
+def _to_paise(rupees) -> int:
+    """Convert a rupee amount (float or Decimal) to integer paise."""
+    return int(round(rupees * 100))
+
+
+# Default per-page prices, converted once
+_PRICE_BW_PAISE = _to_paise(settings.PRICE_PER_PAGE_BW)
+_PRICE_COLOR_PAISE = _to_paise(settings.PRICE_PER_PAGE_COLOR)
+
+
 def calculate_price(
     print_type: PrintType,
     copies: int,
@@ -53,22 +79,22 @@ def calculate_price(
         price_color: Override color price per page
         
     Returns:
-        Total price as Decimal
+        Total price as Decimal (computed in integer paise, so no float rounding)
     """
-    price_bw = price_bw or settings.PRICE_PER_PAGE_BW
-    price_color = price_color or settings.PRICE_PER_PAGE_COLOR
+    bw_paise = _to_paise(price_bw) if price_bw else _PRICE_BW_PAISE
+    color_paise = _to_paise(price_color) if price_color else _PRICE_COLOR_PAISE
     
     if print_type == PrintType.BW:
-        total = page_count * copies * price_bw
+        total_paise = page_count * copies * bw_paise
     elif print_type == PrintType.COLOR:
-        total = page_count * copies * price_color
+        total_paise = page_count * copies * color_paise
     elif print_type == PrintType.BOTH:
         # BOTH means one set of color + one set of BW
-        total = page_count * copies * (price_bw + price_color)
+        total_paise = page_count * copies * (bw_paise + color_paise)
     else:
-        total = 0
+        total_paise = 0
     
-    return Decimal(str(round(total, 2)))
+    return Decimal(total_paise).scaleb(-2)
 
 
 # =============================================================================
@@ -103,8 +129,7 @@ async def create_draft_order(
     )
     
     db.add(order)
-    await db.commit()
-    await db.refresh(order)
+    await db.flush()
     
     logger.info(f"Created draft order {order.id} for {customer_phone}")
     return order
@@ -126,8 +151,7 @@ async def update_order_file(
     order.file_media_id = file_media_id
     order.page_count = page_count
     
-    await db.commit()
-    await db.refresh(order)
+    await db.flush()
     
     logger.info(f"Updated order {order.id} with file: {file_name}")
     return order
@@ -152,8 +176,7 @@ async def update_order_print_config(
         page_count=order.page_count or 1
     )
     
-    await db.commit()
-    await db.refresh(order)
+    await db.flush()
     
     logger.info(f"Updated order {order.id}: {print_type.value}, {copies} copies, ₹{order.amount}")
     return order
@@ -166,26 +189,52 @@ async def finalize_order_with_payment_link(
     """
     Generate Razorpay payment link and finalize order.
     
+    Callers holding row locks should commit first and use
+    request_payment_link / attach_payment_link directly, so no lock is
+    held across the Razorpay call.
+    
     Returns:
         Tuple of (updated order, payment_link_url)
     """
+    payment_url, payment_link_id = await request_payment_link(order)
+    await attach_payment_link(db, order, payment_url, payment_link_id)
+    return order, payment_url
+
+
+async def request_payment_link(order: Order) -> Tuple[str, str]:
+    """
+    Create the Razorpay payment link for a draft order.
+    
+    Makes no database calls.
+    
+    Returns:
+        Tuple of (payment_link_url, payment_link_id)
+    """
     if order.order_status != OrderStatus.DRAFT:
         raise ValueError(f"Order {order.id} is not in DRAFT status")
     
     if not order.amount or order.amount <= 0:
         raise ValueError(f"Order {order.id} has invalid amount")
     
-    # Generate payment link with order ID as reference
-    reference_id = str(order.id)
+    # Generate payment link with order ID as reference (32-char hex, no dashes)
+    reference_id = order.id.hex
     description = f"Print Order: {order.file_name or 'Document'}"
     
-    payment_url, payment_link_id = create_payment_link(
+    return await create_payment_link(
         amount=float(order.amount),
         reference_id=reference_id,
         description=description,
         customer_phone=order.customer_phone
     )
-    
+
+
+async def attach_payment_link(
+    db: AsyncSession,
+    order: Order,
+    payment_url: str,
+    payment_link_id: str
+) -> Order:
+    """Record a created payment link on the order and open its payment."""
     # Update order with payment link info
     order.razorpay_payment_link_id = payment_link_id
     order.razorpay_payment_link_url = payment_url
@@ -200,11 +249,10 @@ async def finalize_order_with_payment_link(
     )
     db.add(payment)
     
-    await db.commit()
-    await db.refresh(order)
+    await db.flush()
     
     logger.info(f"Order {order.id} finalized with payment link: {payment_link_id}")
-    return order, payment_url
+    return order
 
 
 async def confirm_payment(
@@ -227,9 +275,11 @@ async def confirm_payment(
     Returns:
         Updated Order if successful, None if already processed or not found
     """
-    # Find order by payment link ID
+    # Find order and its payment record in one round trip
     result = await db.execute(
-        select(Order).where(Order.razorpay_payment_link_id == payment_link_id)
+        select(Order)
+        .options(joinedload(Order.payment))
+        .where(Order.razorpay_payment_link_id == payment_link_id)
     )
     order = result.scalars().first()
     
@@ -243,11 +293,7 @@ async def confirm_payment(
         return order
     
     # Update payment record
-    result = await db.execute(
-        select(Payment).where(Payment.order_id == order.id)
-    )
-    payment = result.scalars().first()
-    
+    payment = order.payment
     if payment:
         payment.payment_status = PaymentStatus.SUCCESS
         payment.provider_reference = razorpay_payment_id
@@ -265,17 +311,14 @@ async def confirm_payment(
     db.add(print_job)
     
     await db.commit()
-    await db.refresh(order)
-    await db.refresh(print_job)
     
     logger.info(f"Payment confirmed for order {order.id}, print job {print_job.id} created")
     return order
 
 
 async def get_order_by_id(db: AsyncSession, order_id: uuid.UUID) -> Optional[Order]:
-    """Get order by ID."""
-    result = await db.execute(select(Order).where(Order.id == order_id))
-    return result.scalars().first()
+    """Get order by ID (served from the identity map when already loaded)."""
+    return await db.get(Order, order_id)
 
 
 async def get_order_by_payment_link(db: AsyncSession, payment_link_id: str) -> Optional[Order]:
@@ -298,6 +341,9 @@ async def save_uploaded_file(
     """
     Save uploaded file to local storage.
     
+    Goes through save_uploaded_stream, so the content is hashed and written
+    in one pass, a chunk at a time.
+    
     Args:
         file_content: File bytes
         filename: Original filename
@@ -306,26 +352,73 @@ async def save_uploaded_file(
     Returns:
         Tuple of (file_path, file_url)
     """
-    # Create directory structure
-    upload_dir = os.path.join(settings.FILE_STORAGE_PATH, customer_phone.replace("+", "").replace(":", "_"))
-    os.makedirs(upload_dir, exist_ok=True)
-    
-    # Generate unique filename
-    file_hash = hashlib.sha256(file_content).hexdigest()[:16]
-    safe_filename = f"{file_hash}_{filename}"
-    file_path = os.path.join(upload_dir, safe_filename)
+    return await save_uploaded_stream(_iter_chunks(file_content), filename, customer_phone)
+
+
+async def save_uploaded_stream(
+    chunks: AsyncIterator[bytes],
+    filename: str,
+    customer_phone: str
+) -> Tuple[str, str]:
+    """
+    Save a streamed upload to local storage without buffering it in memory.
     
-    # Save file
-    with open(file_path, "wb") as f:
-        f.write(file_content)
+    Chunks are hashed and written as they arrive; the file is renamed to
+    its content-addressed name once complete.
     
-    # Generate URL for file access
-    # This assumes a /files endpoint serves the uploads directory
-    relative_path = os.path.relpath(file_path, settings.FILE_STORAGE_PATH)
-    file_url = f"{settings.BACKEND_PUBLIC_URL}/files/{relative_path.replace(os.sep, '/')}"
+    Args:
+        chunks: Async iterator of file bytes
+        filename: Original filename
+        customer_phone: Customer phone for organizing files
+        
+    Returns:
+        Tuple of (file_path, file_url)
+    """
+    upload_dir = await _get_upload_dir(customer_phone)
+    temp_path = os.path.join(upload_dir, f".{uuid.uuid4().hex}.part")
+    hasher = hashlib.sha256()
+    
+    try:
+        async with aiofiles.open(temp_path, "wb") as f:
+            async for chunk in chunks:
+                hasher.update(chunk)
+                await f.write(chunk)
+        
+        safe_filename = f"{hasher.hexdigest()[:16]}_{filename}"
+        file_path = os.path.join(upload_dir, safe_filename)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        # Don't leave partial downloads behind
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
     
     logger.info(f"Saved file {filename} to {file_path}")
-    return file_path, file_url
+    return file_path, _get_file_url(file_path)
+
+
+async def _get_upload_dir(customer_phone: str) -> str:
+    """Create (if needed) and return the per-customer upload directory."""
+    upload_dir = os.path.join(settings.FILE_STORAGE_PATH, customer_phone.replace("+", "").replace(":", "_"))
+    await asyncio.to_thread(os.makedirs, upload_dir, exist_ok=True)
+    return upload_dir
+
+
+def _get_file_url(file_path: str) -> str:
+    """
+    Generate URL for file access.
+    
+    This assumes a /files endpoint serves the uploads directory.
+    """
+    relative_path = os.path.relpath(file_path, settings.FILE_STORAGE_PATH)
+    return f"{settings.BACKEND_PUBLIC_URL}/files/{relative_path.replace(os.sep, '/')}"
+
+
+async def _iter_chunks(content: bytes) -> AsyncIterator[bytes]:
+    """Yield in-memory content in FILE_CHUNK_SIZE slices (no copies)."""
+    view = memoryview(content)
+    for start in range(0, len(view), FILE_CHUNK_SIZE):
+        yield view[start:start + FILE_CHUNK_SIZE]
 
 
 def compute_file_hash(content: bytes) -> str:
@@ -1,14 +1,252 @@
 from app.core.redis_client import get_redis_client
+from app.core.config import get_settings
+from app.models import PrintJob, PrintStatus
+from sqlalchemy.future import select
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+import asyncio
 import logging
 
 QUEUE_NAME = "print_queue"
 logger = logging.getLogger(__name__)
+settings = get_settings()
 
-def enqueue_print_job(print_job_id: str):
+# QUEUED jobs older than this are checked against the Redis queue by the sweeper
+STALE_JOB_AGE = timedelta(minutes=1)
+
+async def enqueue_print_job(print_job_id: str):
     try:
         redis_client = get_redis_client()
-        redis_client.lpush(QUEUE_NAME, print_job_id)
+        await redis_client.lpush(QUEUE_NAME, print_job_id)
         logger.info(f"Enqueued job {print_job_id} to {QUEUE_NAME}")
     except Exception as e:
         logger.error(f"Failed to enqueue job {print_job_id}: {e}")
-        # In a real system, you might want to retry or mark DB as failed to queue
+        # The sweeper re-pushes QUEUED jobs that never made it to Redis
+
+async def enqueue_print_jobs(print_job_ids: list):
+    """
+    Push several jobs with a single LPUSH.
+    
+    Same list order as one LPUSH per job: the worker BLPOPs from the head,
+    so the last job in the batch is dequeued first.
+    """
+    try:
+        redis_client = get_redis_client()
+        await redis_client.lpush(QUEUE_NAME, *print_job_ids)
+        logger.info(f"Enqueued {len(print_job_ids)} job(s) to {QUEUE_NAME}")
+    except Exception as e:
+        logger.error(f"Failed to enqueue jobs {print_job_ids}: {e}")
+        # The sweeper re-pushes QUEUED jobs that never made it to Redis
+
+async def requeue_stale_jobs() -> int:
+    """
+    Re-push QUEUED jobs that are missing from the Redis queue.
+    
+    Enqueueing happens after the webhook response, so a Redis hiccup can
+    leave a job QUEUED in the database but absent from the queue.
+    Jobs already in the list are skipped; the worker ignores any job
+    that is no longer QUEUED, so an occasional duplicate is harmless.
+    """
+    from app.core.database import AsyncSessionLocal
+    
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(PrintJob.id).where(
+                PrintJob.print_status == PrintStatus.QUEUED,
+                PrintJob.created_at < datetime.utcnow() - STALE_JOB_AGE
+            )
+        )
+        job_ids = [str(job_id) for job_id in result.scalars().all()]
+    
+    if not job_ids:
+        return 0
+    
+    # Check every job's queue position in one round trip
+    async with get_redis_client().pipeline(transaction=False) as pipe:
+        for job_id in job_ids:
+            pipe.lpos(QUEUE_NAME, job_id)
+        positions = await pipe.execute()
+    
+    missing = [job_id for job_id, pos in zip(job_ids, positions) if pos is None]
+    if missing:
+        await enqueue_print_jobs(missing)
+        logger.warning(f"Sweeper re-queued {len(missing)} stale print job(s)")
+    return len(missing)
+
+async def run_sweeper_loop(interval_seconds: int = None):
+    """
+    Periodically re-queue stale jobs. Runs until cancelled.
+    
+    Only the process holding the advisory lock sweeps, so concurrent
+    sweepers can't each push the same missing job.
+    """
+    from app.core.database import AdvisoryLeader, QUEUE_SWEEP_LOCK_KEY
+    
+    interval = interval_seconds or settings.QUEUE_SWEEP_INTERVAL_SECONDS
+    leader = AdvisoryLeader(QUEUE_SWEEP_LOCK_KEY)
+    
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if await leader.acquire():
+                    await requeue_stale_jobs()
+            except Exception as e:
+                logger.error(f"Print queue sweep failed: {e}")
+    finally:
+        await leader.release()
+
+# =============================================================================
+# JOB CACHE
+# =============================================================================
+
+# The worker fetches each job right after dequeue; only status fields change
+JOB_CACHE_PREFIX = "pjob"
+JOB_CACHE_TTL_SECONDS = 300
+# Job listings are polled by dashboards, so a short TTL is enough
+JOB_LIST_CACHE_PREFIX = "pjobs"
+JOB_LIST_CACHE_TTL_SECONDS = 15
+# Bumped on every job write. Listing keys embed it, so a write retires every
+# cached listing at once, and a reader that fetched rows before the bump can
+# only cache them under a key nobody reads any more.
+JOB_LIST_GENERATION_KEY = "pjobs:gen"
+
+def job_cache_key(print_job_id) -> str:
+    return f"{JOB_CACHE_PREFIX}:{print_job_id}"
+
+def _job_version_key(print_job_id) -> str:
+    return f"{JOB_CACHE_PREFIX}:ver:{print_job_id}"
+
+async def get_cached_job(print_job_id) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Return (payload, version) for a job; payload is None on miss.
+    
+    Cached entries are tagged with the job's version, bumped on each write
+    to that job only. Pass the version back to cache_job, so rows read
+    before a concurrent write are never served. version is None when Redis
+    is unavailable.
+    """
+    try:
+        async with get_redis_client().pipeline(transaction=False) as pipe:
+            pipe.get(job_cache_key(print_job_id))
+            pipe.get(_job_version_key(print_job_id))
+            cached, version = await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Job cache read failed for {print_job_id}: {e}")
+        return None, None
+    
+    version = version or "0"
+    tag = f"{version}|"
+    if cached and cached.startswith(tag):
+        return cached[len(tag):], version
+    return None, version
+
+async def cache_job(print_job_id, version: Optional[str], payload: bytes):
+    if version is None:
+        return
+    try:
+        await get_redis_client().set(
+            job_cache_key(print_job_id), f"{version}|".encode() + payload, ex=JOB_CACHE_TTL_SECONDS
+        )
+    except Exception as e:
+        logger.warning(f"Job cache write failed for {print_job_id}: {e}")
+
+async def job_list_cache_key(shop_id, status_filter, limit: int, offset: int) -> Optional[str]:
+    """Cache key for a job listing, or None when Redis is unavailable."""
+    try:
+        generation = int(await get_redis_client().get(JOB_LIST_GENERATION_KEY) or 0)
+    except Exception as e:
+        logger.warning(f"Job list cache generation read failed: {e}")
+        return None
+    return f"{JOB_LIST_CACHE_PREFIX}:{generation}:{shop_id or 'all'}:{status_filter or 'any'}:{limit}:{offset}"
+
+async def get_cached_payload(key: Optional[str]):
+    """Return a cached JSON payload, or None on miss."""
+    if key is None:
+        return None
+    try:
+        return await get_redis_client().get(key)
+    except Exception as e:
+        logger.warning(f"Job cache read failed for {key}: {e}")
+        return None
+
+async def cache_payload(key: Optional[str], payload: bytes, ttl_seconds: int):
+    if key is None:
+        return
+    try:
+        await get_redis_client().set(key, payload, ex=ttl_seconds)
+    except Exception as e:
+        logger.warning(f"Job cache write failed for {key}: {e}")
+
+async def invalidate_job_cache(print_job_id: Optional[str] = None):
+    """
+    Retire cached listings, and the cached job itself when given, after a
+    job is created or changes status.
+    """
+    try:
+        async with get_redis_client().pipeline(transaction=False) as pipe:
+            if print_job_id:
+                # Outlives any entry tagged with the old version
+                pipe.incr(_job_version_key(print_job_id))
+                pipe.expire(_job_version_key(print_job_id), JOB_CACHE_TTL_SECONDS)
+            pipe.incr(JOB_LIST_GENERATION_KEY)
+            await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Job cache invalidation failed: {e}")
+
+# =============================================================================
+# ENQUEUE BATCHING
+# =============================================================================
+
+# Enqueues arriving within this window go to Redis in one LPUSH
+ENQUEUE_BATCH_WINDOW_SECONDS = 0.005
+ENQUEUE_BATCH_MAX = 100
+
+_pending_jobs: Optional[asyncio.Queue] = None
+
+async def queue_print_job(print_job_id: str):
+    """
+    Hand a job to the enqueue batcher without waiting on Redis.
+    
+    Falls back to a direct push when the batcher isn't running
+    (e.g. scripts outside the web app).
+    """
+    if _pending_jobs is None:
+        await enqueue_print_job(print_job_id)
+        return
+    _pending_jobs.put_nowait(print_job_id)
+
+async def run_enqueue_batcher():
+    """
+    Coalesce queued jobs and push each batch with one LPUSH.
+    
+    Runs until cancelled (on application shutdown), then flushes
+    whatever is still pending.
+    """
+    global _pending_jobs
+    _pending_jobs = asyncio.Queue()
+    loop = asyncio.get_running_loop()
+    batch = []
+    
+    try:
+        while True:
+            batch = [await _pending_jobs.get()]
+            deadline = loop.time() + ENQUEUE_BATCH_WINDOW_SECONDS
+            
+            while len(batch) < ENQUEUE_BATCH_MAX:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(_pending_jobs.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            await enqueue_print_jobs(batch)
+            batch = []
+    finally:
+        pending, _pending_jobs = _pending_jobs, None
+        while not pending.empty():
+            batch.append(pending.get_nowait())
+        if batch:
+            await enqueue_print_jobs(batch)
@@ -4,22 +4,51 @@ Razorpay Service for AMP K
 Handles payment link creation and webhook signature verification.
 """
 
-import razorpay
 from app.core.config import get_settings
 from fastapi import HTTPException
 import hmac
 import hashlib
+import httpx
 import logging
-from typing import Tuple
+from typing import AsyncIterator, Optional, Tuple
 
 settings = get_settings()
 logger = logging.getLogger(__name__)
 
-# Initialize Razorpay Client
-client = razorpay.Client(auth=(settings.RAZORPAY_KEY_ID, settings.RAZORPAY_KEY_SECRET))
+RAZORPAY_API_BASE = "https://api.razorpay.com/v1"
 
+# Shared HTTP client for the Razorpay REST API (keeps connections and TLS sessions alive)
+_http_client: Optional[httpx.AsyncClient] = None
 
-def create_payment_link(
+# Webhook HMAC key, encoded once
+_WEBHOOK_SECRET = settings.RAZORPAY_WEBHOOK_SECRET.encode('utf-8')
+
+# Hex-encoded SHA-256 signatures are always this long
+_SIG_HEX_LEN = 64
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Get or create the pooled Razorpay API client singleton."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            base_url=RAZORPAY_API_BASE,
+            auth=(settings.RAZORPAY_KEY_ID, settings.RAZORPAY_KEY_SECRET),
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+            timeout=30.0
+        )
+    return _http_client
+
+
+async def close_http_client():
+    """Close the pooled Razorpay API client (called on application shutdown)."""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+async def create_payment_link(
     amount: float,
     reference_id: str,
     description: str = "AMP K Print Order",
@@ -49,7 +78,7 @@ def create_payment_link(
             phone = "+910000000000"
         
         data = {
-            "amount": int(amount * 100),  # Convert to paise
+            "amount": int(round(amount * 100)),  # Convert to paise
             "currency": "INR",
             "accept_partial": False,
             "reference_id": reference_id,
@@ -72,7 +101,9 @@ def create_payment_link(
             }
         }
         
-        payment_link = client.payment_link.create(data)
+        response = await get_http_client().post("/payment_links", json=data)
+        response.raise_for_status()
+        payment_link = response.json()
         
         logger.info(f"Created payment link {payment_link['id']} for reference {reference_id}")
         return payment_link['short_url'], payment_link['id']
@@ -82,38 +113,65 @@ def create_payment_link(
         raise HTTPException(status_code=500, detail="Failed to create payment link")
 
 
-def verify_webhook_signature(body: bytes, signature: str) -> bool:
+async def read_verified_webhook_body(
+    chunks: AsyncIterator[bytes],
+    signature: str
+) -> Optional[bytes]:
     """
-    Verifies the Razorpay webhook signature using HMAC SHA256.
+    Read a webhook body while hashing it, chunk by chunk.
+    
+    The HMAC is updated as each chunk arrives, so verification finishes
+    as soon as the last byte does.
     
     Args:
-        body: Raw request body bytes
+        chunks: Request body stream (e.g. request.stream())
         signature: X-Razorpay-Signature header value
         
     Returns:
-        True if signature is valid, False otherwise
+        The raw body if the signature is valid, None otherwise
     """
+    if not _signature_well_formed(signature):
+        return None
+    
+    mac = hmac.new(_WEBHOOK_SECRET, None, hashlib.sha256)
+    parts = []
+    async for chunk in chunks:
+        mac.update(chunk)
+        parts.append(chunk)
+    
+    if not _signature_matches(mac.digest(), signature):
+        return None
+    
+    return b"".join(parts)
+
+
+def _signature_well_formed(signature: str) -> bool:
+    """Reject missing or wrong-length signatures before hashing anything."""
     if not signature:
         logger.warning("No signature provided")
         return False
-        
+    if len(signature) != _SIG_HEX_LEN:
+        logger.warning(f"Signature has wrong length: {len(signature)}")
+        return False
+    return True
+
+
+def _signature_matches(expected: bytes, signature: str) -> bool:
+    """Compare an HMAC digest against the hex signature header in constant time."""
     try:
-        secret = settings.RAZORPAY_WEBHOOK_SECRET.encode('utf-8')
-        generated_signature = hmac.new(secret, body, hashlib.sha256).hexdigest()
-        
-        is_valid = hmac.compare_digest(generated_signature, signature)
-        
-        if not is_valid:
-            logger.warning(f"Signature mismatch. Expected: {generated_signature[:20]}..., Got: {signature[:20]}...")
-        
-        return is_valid
-        
-    except Exception as e:
-        logger.error(f"Signature verification failed: {e}")
+        # Compare raw digest bytes (no hex round-trip)
+        is_valid = hmac.compare_digest(expected, bytes.fromhex(signature))
+    except ValueError:
+        logger.warning("Signature is not valid hex")
         return False
+    
+    if not is_valid:
+        logger.warning(f"Signature mismatch. Got: {signature[:20]}...")
+    
+    return is_valid
 
 
-def get_payment_link_status(payment_link_id: str) -> dict:
+async def get_payment_link_status(payment_link_id: str) -> dict:
     """
     Fetch payment link status from Razorpay.
     
@@ -124,7 +182,9 @@ def get_payment_link_status(payment_link_id: str) -> dict:
         Payment link details dict
     """
     try:
-        return client.payment_link.fetch(payment_link_id)
+        response = await get_http_client().get(f"/payment_links/{payment_link_id}")
+        response.raise_for_status()
+        return response.json()
     except Exception as e:
         logger.error(f"Failed to fetch payment link {payment_link_id}: {e}")
         return None
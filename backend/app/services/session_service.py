@@ -3,6 +3,14 @@ Session Service for AMP K
 
 Manages user conversation state for WhatsApp bot flow.
 Implements a state machine for order creation process.
+
+Functions here only mutate the session; the caller commits the changes.
+
+get_or_create_session locks the user's session row until that commit, so
+concurrent messages from the same number (double sends, redeliveries) are
+handled one after another instead of racing on the same state. Callers
+take the lock only around the state read-modify-write: media downloads
+and payment link creation happen outside the locked transaction.
 """
 
 import uuid
@@ -10,6 +18,7 @@ from datetime import datetime, timedelta
 from typing import Optional
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 from app.models import UserSession, ConversationState, Order, PrintType
 from app.core.config import get_settings
@@ -26,6 +35,9 @@ async def get_or_create_session(db: AsyncSession, phone: str) -> UserSession:
     """
     Get existing session or create a new one for the phone number.
     
+    The row is selected FOR UPDATE and stays locked until the caller
+    commits or rolls back.
+    
     Args:
         db: Database session
         phone: Customer phone number (with whatsapp: prefix)
@@ -36,39 +48,44 @@ async def get_or_create_session(db: AsyncSession, phone: str) -> UserSession:
     # Normalize phone number
     normalized_phone = phone.strip()
     
-    result = await db.execute(
-        select(UserSession).where(UserSession.phone == normalized_phone)
+    locked_select = (
+        select(UserSession)
+        .where(UserSession.phone == normalized_phone)
+        .with_for_update()
     )
+    
+    result = await db.execute(locked_select)
     session = result.scalars().first()
     
-    if session:
-        # Check if session is expired
-        if is_session_expired(session):
-            # Reset expired session
-            session.state = ConversationState.IDLE
-            session.draft_order_id = None
-            session.temp_file_url = None
-            session.temp_file_name = None
-            session.temp_file_media_id = None
-            session.temp_print_type = None
-            logger.info(f"Reset expired session for {phone}")
-        
-        session.last_activity = datetime.utcnow()
-        await db.commit()
-        await db.refresh(session)
+    if session is None:
+        # Create the row, tolerating a concurrent first message that got
+        # there first, then lock whichever row won
+        await db.execute(
+            pg_insert(UserSession)
+            .values(
+                phone=normalized_phone,
+                state=ConversationState.IDLE,
+                last_activity=datetime.utcnow()
+            )
+            .on_conflict_do_nothing(index_elements=[UserSession.phone])
+        )
+        result = await db.execute(locked_select)
+        session = result.scalars().one()
+        logger.info(f"Created new session for {phone}")
         return session
     
-    # Create new session
-    session = UserSession(
-        phone=normalized_phone,
-        state=ConversationState.IDLE,
-        last_activity=datetime.utcnow()
-    )
-    db.add(session)
-    await db.commit()
-    await db.refresh(session)
+    # Check if session is expired
+    if is_session_expired(session):
+        # Reset expired session
+        session.state = ConversationState.IDLE
+        session.draft_order_id = None
+        session.temp_file_url = None
+        session.temp_file_name = None
+        session.temp_file_media_id = None
+        session.temp_print_type = None
+        logger.info(f"Reset expired session for {phone}")
     
-    logger.info(f"Created new session for {phone}")
+    session.last_activity = datetime.utcnow()
     return session
 
 
@@ -91,9 +108,6 @@ async def update_session_state(
     session.state = new_state
     session.last_activity = datetime.utcnow()
     
-    await db.commit()
-    await db.refresh(session)
-    
     logger.info(f"Session {session.phone}: {old_state} -> {new_state}")
     return session
 
@@ -112,9 +126,6 @@ async def store_temp_file(
     session.state = ConversationState.AWAITING_PRINT_TYPE
     session.last_activity = datetime.utcnow()
     
-    await db.commit()
-    await db.refresh(session)
-    
     return session
 
 
@@ -128,9 +139,6 @@ async def store_temp_print_type(
     session.state = ConversationState.AWAITING_COPIES
     session.last_activity = datetime.utcnow()
     
-    await db.commit()
-    await db.refresh(session)
-    
     return session
 
 
@@ -144,8 +152,19 @@ async def link_order_to_session(
     session.state = ConversationState.AWAITING_PAYMENT
     session.last_activity = datetime.utcnow()
     
-    await db.commit()
-    await db.refresh(session)
+    return session
+
+
+async def unlink_order_from_session(
+    db: AsyncSession,
+    session: UserSession,
+    order_id: uuid.UUID
+) -> UserSession:
+    """Send the session back to copy selection if it still points at the order."""
+    if session.draft_order_id == order_id:
+        session.draft_order_id = None
+        session.state = ConversationState.AWAITING_COPIES
+        session.last_activity = datetime.utcnow()
     
     return session
 
@@ -160,9 +179,6 @@ async def clear_session(db: AsyncSession, session: UserSession) -> UserSession:
     session.temp_print_type = None
     session.last_activity = datetime.utcnow()
     
-    await db.commit()
-    await db.refresh(session)
-    
     logger.info(f"Cleared session for {session.phone}")
     return session
 
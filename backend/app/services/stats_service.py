@@ -0,0 +1,187 @@
+"""
+Stats Service for AMP K
+
+Maintains the daily order rollup that backs the dashboard statistics.
+
+Historical days are served from the `mv_daily_order_stats` materialized view,
+which is refreshed periodically in the background and right after each UTC
+midnight. The view only holds orders last updated before the midnight it
+was built on (its `as_of` column); everything since is aggregated live
+from the `orders` table. The split is by each order's updated_at at refresh
+time: an order in the view that is updated again also shows up in the live
+part, so it counts twice until the next refresh.
+
+Rendered stats responses are cached briefly in Redis, since dashboards
+poll this endpoint every few seconds.
+"""
+
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Optional
+from uuid import UUID
+
+from sqlalchemy import text
+from sqlalchemy.sql import table, column
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from app.core.config import get_settings
+from app.core.database import engine, AdvisoryLeader, STATS_REFRESH_LOCK_KEY
+from app.core.redis_client import get_redis_client
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+# Lightweight table construct for querying the view (not part of Base.metadata,
+# so create_all never tries to create it as a regular table)
+mv_daily_order_stats = table(
+    "mv_daily_order_stats",
+    column("shop_id"),
+    column("created_day"),
+    column("updated_day"),
+    column("order_status"),
+    column("order_count"),
+    column("revenue_sum"),
+    column("as_of"),
+)
+
+CREATE_VIEW_SQL = """
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_daily_order_stats AS
+SELECT
+    shop_id,
+    date_trunc('day', created_at) AS created_day,
+    date_trunc('day', updated_at) AS updated_day,
+    order_status::text AS order_status,
+    count(*) AS order_count,
+    coalesce(sum(amount), 0) AS revenue_sum,
+    date_trunc('day', timezone('utc', now())) AS as_of
+FROM orders
+WHERE updated_at < date_trunc('day', timezone('utc', now()))
+GROUP BY 1, 2, 3, 4
+"""
+
+# Views created before the as_of cutoff existed are rebuilt at startup
+VIEW_HAS_CUTOFF_SQL = """
+SELECT 1 FROM pg_attribute
+WHERE attrelid = to_regclass('mv_daily_order_stats') AND attname = 'as_of'
+"""
+DROP_VIEW_SQL = "DROP MATERIALIZED VIEW IF EXISTS mv_daily_order_stats"
+
+# REFRESH ... CONCURRENTLY requires a unique index covering every row
+CREATE_VIEW_INDEX_SQL = """
+CREATE UNIQUE INDEX IF NOT EXISTS ux_mv_daily_order_stats
+ON mv_daily_order_stats (shop_id, created_day, updated_day, order_status)
+"""
+
+REFRESH_VIEW_SQL = "REFRESH MATERIALIZED VIEW CONCURRENTLY mv_daily_order_stats"
+
+# Refresh this long after midnight, so the new day's cutoff is in effect
+MIDNIGHT_REFRESH_DELAY_SECONDS = 5
+
+# Stats response cache
+STATS_CACHE_PREFIX = "dash:stats"
+STATS_CACHE_TTL_SECONDS = 15
+
+
+async def ensure_daily_stats_view(conn: AsyncConnection):
+    """Create the rollup view and its unique index if missing."""
+    has_cutoff = (await conn.execute(text(VIEW_HAS_CUTOFF_SQL))).first()
+    if has_cutoff is None:
+        await conn.execute(text(DROP_VIEW_SQL))
+    await conn.execute(text(CREATE_VIEW_SQL))
+    await conn.execute(text(CREATE_VIEW_INDEX_SQL))
+
+
+async def refresh_daily_stats_view():
+    """Refresh the rollup view without blocking readers."""
+    async with engine.begin() as conn:
+        await conn.execute(text(REFRESH_VIEW_SQL))
+    logger.debug("Refreshed mv_daily_order_stats")
+
+
+async def run_refresh_loop(interval_seconds: int = None):
+    """
+    Periodically refresh the rollup view.
+
+    Also wakes just after each UTC midnight, so the previous day moves into
+    the view as soon as it closes. Only the process holding the advisory
+    lock refreshes; the others just keep trying to take it over. Runs until
+    cancelled (on application shutdown).
+    """
+    interval = interval_seconds or settings.STATS_REFRESH_INTERVAL_SECONDS
+    leader = AdvisoryLeader(STATS_REFRESH_LOCK_KEY)
+
+    try:
+        while True:
+            now = datetime.utcnow()
+            next_midnight = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+            until_midnight = (next_midnight - now).total_seconds() + MIDNIGHT_REFRESH_DELAY_SECONDS
+            await asyncio.sleep(min(interval, until_midnight))
+            try:
+                if await leader.acquire():
+                    await refresh_daily_stats_view()
+            except Exception as e:
+                logger.error(f"Failed to refresh daily stats view: {e}")
+    finally:
+        await leader.release()
+
+
+# =============================================================================
+# RESPONSE CACHE
+# =============================================================================
+
+def _stats_scope(shop_id: Optional[UUID]) -> str:
+    return str(shop_id) if shop_id else "all"
+
+
+def _stats_generation_key(scope: str) -> str:
+    return f"{STATS_CACHE_PREFIX}:gen:{scope}"
+
+
+async def stats_cache_key(shop_id: Optional[UUID], days: int) -> Optional[str]:
+    """
+    Cache key for a stats response, or None when Redis is unavailable.
+    
+    The key embeds the scope's generation counter, so invalidating is a
+    single INCR and stale entries simply age out.
+    """
+    scope = _stats_scope(shop_id)
+    try:
+        generation = int(await get_redis_client().get(_stats_generation_key(scope)) or 0)
+    except Exception as e:
+        logger.warning(f"Stats cache generation read failed: {e}")
+        return None
+    return f"{STATS_CACHE_PREFIX}:{scope}:{generation}:{days}"
+
+
+async def get_cached_stats(key: Optional[str]) -> Optional[str]:
+    """Return the cached JSON stats payload, or None on miss."""
+    if key is None:
+        return None
+    try:
+        return await get_redis_client().get(key)
+    except Exception as e:
+        logger.warning(f"Stats cache read failed: {e}")
+        return None
+
+
+async def cache_stats(key: Optional[str], payload: bytes):
+    """Store a serialized stats payload with a short TTL."""
+    if key is None:
+        return
+    try:
+        await get_redis_client().set(key, payload, ex=STATS_CACHE_TTL_SECONDS)
+    except Exception as e:
+        logger.warning(f"Stats cache write failed: {e}")
+
+
+async def invalidate_stats_cache(shop_id: Optional[UUID]):
+    """Retire cached stats for a shop (and the all-shops view) after a payment."""
+    try:
+        async with get_redis_client().pipeline(transaction=False) as pipe:
+            pipe.incr(_stats_generation_key("all"))
+            if shop_id:
+                pipe.incr(_stats_generation_key(_stats_scope(shop_id)))
+            await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Stats cache invalidation failed: {e}")
@@ -8,33 +8,66 @@ Note: Twilio WhatsApp Sandbox has limitations on button messages.
 For production, use approved templates.
 """
 
-from twilio.rest import Client
 from twilio.twiml.messaging_response import MessagingResponse
 from app.core.config import get_settings
+from app.core.redis_client import get_redis_client
 import logging
 import httpx
 from typing import Optional, List
 from urllib.parse import urljoin
+from contextlib import asynccontextmanager
 
 settings = get_settings()
 logger = logging.getLogger(__name__)
 
-# Initialize Twilio client
-_client = None
+# Twilio REST endpoint for sending messages
+MESSAGES_URL = (
+    f"https://api.twilio.com/2010-04-01/Accounts/{settings.TWILIO_ACCOUNT_SID}/Messages.json"
+)
 
+# Sender address, normalized once
+_FROM_NUMBER = settings.TWILIO_WHATSAPP_NUMBER
+if _FROM_NUMBER and not _FROM_NUMBER.startswith("whatsapp:"):
+    _FROM_NUMBER = f"whatsapp:{_FROM_NUMBER}"
 
-def get_twilio_client() -> Optional[Client]:
-    """Get or create Twilio client singleton."""
-    global _client
-    if _client is None and settings.TWILIO_ACCOUNT_SID and settings.TWILIO_AUTH_TOKEN:
-        _client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
-    return _client
+# Shared HTTP client for Twilio API calls (keeps connections and TLS sessions alive)
+_http_client: Optional[httpx.AsyncClient] = None
+
+# Read size for streamed media downloads
+MEDIA_CHUNK_SIZE = 64 * 1024
+
+# Inbound message dedup (Twilio retries a webhook it thinks failed)
+INBOUND_MSG_PREFIX = "wa:msg"
+INBOUND_MSG_TTL_SECONDS = 3600
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Get or create the pooled HTTP client singleton."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            timeout=60.0,
+            follow_redirects=True
+        )
+    return _http_client
+
+
+async def close_http_client():
+    """Close the pooled HTTP client (called on application shutdown)."""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
 
 
 async def send_whatsapp_message(to: str, body: str) -> bool:
     """
     Send a simple text message via Twilio WhatsApp.
     
+    Posts to the Twilio REST API over the pooled HTTP client, so sends
+    don't block the event loop and reuse open connections.
+    
     Args:
         to: Recipient phone number (e.g., "whatsapp:+919876543210")
         body: Message text
@@ -43,8 +76,7 @@ async def send_whatsapp_message(to: str, body: str) -> bool:
         True if sent successfully, False otherwise
     """
     try:
-        client = get_twilio_client()
-        if not client:
+        if not (settings.TWILIO_ACCOUNT_SID and settings.TWILIO_AUTH_TOKEN):
             logger.error("Twilio client not configured")
             return False
         
@@ -52,17 +84,14 @@ async def send_whatsapp_message(to: str, body: str) -> bool:
         if not to.startswith("whatsapp:"):
             to = f"whatsapp:{to}"
         
-        from_number = settings.TWILIO_WHATSAPP_NUMBER
-        if not from_number.startswith("whatsapp:"):
-            from_number = f"whatsapp:{from_number}"
-        
-        message = client.messages.create(
-            body=body,
-            from_=from_number,
-            to=to
+        response = await get_http_client().post(
+            MESSAGES_URL,
+            data={"From": _FROM_NUMBER, "To": to, "Body": body},
+            auth=(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
         )
+        response.raise_for_status()
         
-        logger.info(f"Sent WhatsApp message to {to}: {message.sid}")
+        logger.info(f"Sent WhatsApp message to {to}: {response.json().get('sid')}")
         return True
         
     except Exception as e:
@@ -100,51 +129,71 @@ async def send_button_message(to: str, body: str, buttons: List[dict]) -> bool:
     return await send_whatsapp_message(to, full_message)
 
 
-async def download_media_file(media_url: str, media_sid: str) -> Optional[tuple]:
+@asynccontextmanager
+async def stream_media_file(media_url: str, media_sid: str):
     """
-    Download a media file from Twilio.
+    Open a streaming download of a media file from Twilio.
     
-    Twilio media URLs require authentication.
+    Twilio media URLs require authentication. The body is not read here:
+    iterate `response.aiter_bytes(MEDIA_CHUNK_SIZE)` to consume it, so
+    large documents never sit in memory as a whole.
     
     Args:
         media_url: The Twilio media URL
         media_sid: The MediaSid for logging
         
-    Returns:
-        Tuple of (file_bytes, content_type, filename) or None on failure
+    Yields:
+        Tuple of (response, content_type, filename)
+        
+    Raises:
+        httpx.HTTPError on connection or HTTP status failures
     """
-    try:
-        # Twilio media URLs require basic auth
-        auth = (settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+    # Twilio media URLs require basic auth
+    auth = (settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+    
+    async with get_http_client().stream("GET", media_url, auth=auth) as response:
+        response.raise_for_status()
+        
+        content_type = response.headers.get("content-type", "application/octet-stream")
         
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                media_url,
-                auth=auth,
-                follow_redirects=True,
-                timeout=60.0
-            )
-            response.raise_for_status()
-            
-            content_type = response.headers.get("content-type", "application/octet-stream")
-            
-            # Try to get filename from content-disposition or generate one
-            content_disp = response.headers.get("content-disposition", "")
-            filename = None
-            if "filename=" in content_disp:
-                filename = content_disp.split("filename=")[-1].strip('"\'')
-            
-            if not filename:
-                # Generate filename from media_sid and content type
-                ext = _get_extension_from_content_type(content_type)
-                filename = f"{media_sid}{ext}"
-            
-            logger.info(f"Downloaded media {media_sid}: {len(response.content)} bytes, {content_type}")
-            return (response.content, content_type, filename)
-            
+        # Try to get filename from content-disposition or generate one
+        content_disp = response.headers.get("content-disposition", "")
+        filename = None
+        if "filename=" in content_disp:
+            filename = content_disp.split("filename=")[-1].strip('"\'')
+        
+        if not filename:
+            # Generate filename from media_sid and content type
+            ext = _get_extension_from_content_type(content_type)
+            filename = f"{media_sid}{ext}"
+        
+        logger.info(f"Streaming media {media_sid}: {content_type}")
+        yield response, content_type, filename
+
+
+async def claim_inbound_message(message_sid: str) -> bool:
+    """
+    Mark an inbound message as being handled.
+    
+    Returns False if the same MessageSid was already claimed, i.e. this
+    delivery is a retry. Fails open if Redis is unavailable.
+    """
+    try:
+        claimed = await get_redis_client().set(
+            f"{INBOUND_MSG_PREFIX}:{message_sid}", "1", nx=True, ex=INBOUND_MSG_TTL_SECONDS
+        )
+        return bool(claimed)
+    except Exception as e:
+        logger.warning(f"Inbound message dedup failed for {message_sid}: {e}")
+        return True
+
+
+async def release_inbound_message(message_sid: str):
+    """Drop a claim so a retry of a failed message is processed again."""
+    try:
+        await get_redis_client().delete(f"{INBOUND_MSG_PREFIX}:{message_sid}")
     except Exception as e:
-        logger.error(f"Failed to download media {media_sid}: {e}")
-        return None
+        logger.warning(f"Inbound message release failed for {message_sid}: {e}")
 
 
 def _get_extension_from_content_type(content_type: str) -> str:
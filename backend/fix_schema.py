@@ -5,6 +5,8 @@ import os
 # Add the current directory to sys.path to allow imports
 sys.path.append(os.getcwd())
 
+from sqlalchemy import text
+
 from app.core.database import engine, Base
 from app.models import Shop, Order, Payment, PrintJob
 
@@ -12,6 +14,10 @@ async def reset_db():
     print("Resetting database schema to enforce UUIDs...")
     try:
         async with engine.begin() as conn:
+            # The dashboard rollup view depends on orders; drop it first
+            # (the app recreates it on startup)
+            await conn.execute(text("DROP MATERIALIZED VIEW IF EXISTS mv_daily_order_stats"))
+            
             # Drop all tables to remove incompatible VARCHAR columns
             print("Dropping existing tables...")
             await conn.run_sync(Base.metadata.drop_all)
@@ -44,7 +44,7 @@ CREATE TABLE IF NOT EXISTS orders (
     amount NUMERIC(10,2) DEFAULT 0 CHECK (amount >= 0),
     
     -- Razorpay binding
-    razorpay_payment_link_id VARCHAR(255) UNIQUE,
+    razorpay_payment_link_id VARCHAR(255),
     razorpay_payment_link_url TEXT,
     
     -- Status
@@ -61,7 +61,18 @@ CREATE TABLE IF NOT EXISTS orders (
 
 CREATE INDEX IF NOT EXISTS idx_orders_phone ON orders(customer_phone);
 CREATE INDEX IF NOT EXISTS idx_orders_shop_status ON orders(shop_id, order_status);
-CREATE INDEX IF NOT EXISTS idx_orders_payment_link ON orders(razorpay_payment_link_id);
+-- Unique payment link lookup that also covers the paid-webhook columns (index-only scan)
+CREATE UNIQUE INDEX IF NOT EXISTS ix_orders_plink_covering ON orders(razorpay_payment_link_id)
+    INCLUDE (id, order_status, shop_id, customer_phone);
+-- Older indexes on the column: the inline UNIQUE constraint (schema.sql),
+-- the create_all-generated unique index, and the plain lookup index
+ALTER TABLE orders DROP CONSTRAINT IF EXISTS orders_razorpay_payment_link_id_key;
+DROP INDEX IF EXISTS ix_orders_razorpay_payment_link_id;
+DROP INDEX IF EXISTS idx_orders_payment_link;
+CREATE INDEX IF NOT EXISTS idx_orders_created_id ON orders(created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_orders_shop_created ON orders(shop_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_orders_paid_updated ON orders(shop_id, updated_at DESC)
+    WHERE order_status = 'PAID';
 
 -- =============================================================================
 -- 3. PAYMENTS
@@ -111,7 +122,13 @@ CREATE TABLE IF NOT EXISTS print_jobs (
     CONSTRAINT uq_print_job_order UNIQUE(order_id)
 );
 
-CREATE INDEX IF NOT EXISTS idx_print_jobs_queue ON print_jobs(shop_id, print_status, created_at);
+-- Covers the job listing (filter by shop/status, newest first) as an index-only scan
+DROP INDEX IF EXISTS idx_print_jobs_queue;
+CREATE INDEX IF NOT EXISTS idx_print_jobs_shop_status_created
+    ON print_jobs(shop_id, print_status, created_at DESC)
+    INCLUDE (id, order_id, retry_count, printed_at);
+CREATE INDEX IF NOT EXISTS idx_print_jobs_failed_updated ON print_jobs(shop_id, updated_at DESC)
+    WHERE print_status = 'FAILED';
 
 -- =============================================================================
 -- 5. USER_SESSIONS (Conversation State)
@@ -139,6 +156,8 @@ CREATE TABLE IF NOT EXISTS user_sessions (
 );
 
 CREATE INDEX IF NOT EXISTS idx_user_sessions_phone ON user_sessions(phone);
+CREATE INDEX IF NOT EXISTS idx_user_sessions_draft_order ON user_sessions(draft_order_id)
+    WHERE draft_order_id IS NOT NULL;
 
 -- =============================================================================
 -- 6. WEBHOOK_LOGS (Idempotency)
@@ -184,7 +203,31 @@ BEFORE UPDATE ON print_jobs
 FOR EACH ROW EXECUTE FUNCTION touch_updated_at();
 
 -- =============================================================================
--- 8. DEFAULT DATA
+-- 8. DASHBOARD ROLLUP (refreshed periodically by the backend)
+-- =============================================================================
+-- Derived data only: rebuilt so older definitions pick up the as_of cutoff.
+-- Holds orders last updated before the UTC midnight it was built on;
+-- the dashboard aggregates everything since then live.
+DROP MATERIALIZED VIEW IF EXISTS mv_daily_order_stats;
+CREATE MATERIALIZED VIEW mv_daily_order_stats AS
+SELECT
+    shop_id,
+    date_trunc('day', created_at) AS created_day,
+    date_trunc('day', updated_at) AS updated_day,
+    order_status::text AS order_status,
+    count(*) AS order_count,
+    coalesce(sum(amount), 0) AS revenue_sum,
+    date_trunc('day', timezone('utc', now())) AS as_of
+FROM orders
+WHERE updated_at < date_trunc('day', timezone('utc', now()))
+GROUP BY 1, 2, 3, 4;
+
+-- Required for REFRESH MATERIALIZED VIEW CONCURRENTLY
+CREATE UNIQUE INDEX IF NOT EXISTS ux_mv_daily_order_stats
+ON mv_daily_order_stats (shop_id, created_day, updated_day, order_status);
+
+-- =============================================================================
+-- 9. DEFAULT DATA
 -- =============================================================================
 -- Insert a default shop if none exists
 INSERT INTO shops (id, name, location, is_active, price_per_page_bw, price_per_page_color)
@@ -207,6 +207,11 @@ class PrintWorker:
                 logger.error(f"Failed to fetch job details for {job_id}")
                 return
             
+            # Skip duplicates (e.g. re-queued by the backend sweeper)
+            if job.get('print_status') != 'QUEUED':
+                logger.info(f"Job {job_id} is {job.get('print_status')}, skipping")
+                return
+            
             file_url = job.get('file_url')
             file_name = job.get('file_name', 'document')
             copies = job.get('copies', 1)